@@ -0,0 +1,86 @@
+#!/bin/env python
+"""
+Benchmark for the chunking and compression options of the converted
+trajectory HDF5 files. An existing trajectory is rewritten with every
+combination of chunk size, compression filter and coordinate precision
+(float32 or fixed precision int32, see TunedHDF5TrajectoryFile), and for
+each one the write throughput, file size and random frame access speed(as
+done by load_frame) are reported.
+
+Usage:
+    python benchmark_hdf5_storage.py <trajectory.hdf5> [n_random_frames]
+"""
+from __future__ import print_function, division
+import os
+import sys
+import time
+import itertools
+import numpy as np
+import tables
+import mdtraj as md
+from mdtraj.utils.contextmanagers import enter_temp_directory
+from kinase_msm.convert_project import TunedHDF5TrajectoryFile, \
+    HDF5TrajectoryFileWrapper
+from kinase_msm.data_loader import load_hdf5
+
+chunk_options = [None, 10, 100]
+filter_options = [(None, 0), ("zlib", 1), ("zlib", 5), ("blosc:lz4", 5)]
+precision_options = [None, 1000]
+
+
+def benchmark_storage(trj, chunk_frames, complib, complevel, frame_indices,
+                      precision=None):
+    """
+    :param trj: trajectory to write
+    :param chunk_frames: frames per chunk
+    :param complib: compression library
+    :param complevel: compression level
+    :param frame_indices: frames to read back at random
+    :param precision: fixed coordinate precision, None for float32
+    :return: write frames/sec, file size in MB, random reads/sec
+    """
+    fname = "benchmark.h5"
+    start = time.time()
+    f = TunedHDF5TrajectoryFile(fname, mode='w', chunk_frames=chunk_frames,
+                                complib=complib, complevel=complevel,
+                                precision=precision)
+    wrapper = HDF5TrajectoryFileWrapper(f)
+    wrapper.setup(trj.topology)
+    wrapper.write_file("benchmark", trj)
+    f.close()
+    write_rate = trj.n_frames / (time.time() - start)
+    size = os.path.getsize(fname) / 1024.0 ** 2
+
+    start = time.time()
+    for index in frame_indices:
+        load_hdf5(fname, frame_index=index)
+    read_rate = len(frame_indices) / (time.time() - start)
+    os.remove(fname)
+    return write_rate, size, read_rate
+
+
+def main():
+    trj = md.load(sys.argv[1])
+    n_random_frames = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    frame_indices = np.random.randint(0, trj.n_frames, n_random_frames)
+    print("%-10s %-12s %-10s %14s %10s %14s" %
+          ("chunk", "filter", "precision", "write fr/sec", "size MB",
+           "random fr/sec"))
+    with enter_temp_directory():
+        for chunk_frames, (complib, complevel), precision in \
+                itertools.product(chunk_options, filter_options,
+                                  precision_options):
+            if complib is not None and \
+                    tables.which_lib_version(complib) is None:
+                continue
+            write_rate, size, read_rate = benchmark_storage(
+                trj, chunk_frames, complib, complevel, frame_indices,
+                precision)
+            print("%-10s %-12s %-10s %14.1f %10.2f %14.1f" %
+                  (chunk_frames, "%s-%d" % (complib, complevel), precision,
+                   write_rate, size, read_rate))
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+#!/bin/env python
+"""
+Benchmark for the Folding@Home results loaders in convert_project.
+Reads every results file of a single CLONE with each loader and reports
+the number of results files processed per second.
+
+Usage:
+    python benchmark_traj_loader.py <clone_dir> <topology.pdb> [n_repeats]
+"""
+from __future__ import print_function, division
+import os
+import sys
+import glob
+import time
+import mdtraj as md
+from msmbuilder.dataset import _keynat as keynat
+from kinase_msm.convert_project import _traj_loaders
+
+
+def benchmark_loader(loader, filenames, top, n_repeats=1):
+    """
+    :param loader: Name of the loader in _traj_loaders
+    :param filenames: list of results files
+    :param top: The topology
+    :param n_repeats: Number of passes over the files
+    :return: results files per second
+    """
+    traj_loader = _traj_loaders[loader]
+    start = time.time()
+    for _ in range(n_repeats):
+        for filename in filenames:
+            traj_loader(filename, top)
+    return n_repeats * len(filenames) / (time.time() - start)
+
+
+def main():
+    clone_dir, top_file = os.path.abspath(sys.argv[1]), sys.argv[2]
+    n_repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+
+    top = md.load(top_file)
+    filenames = sorted(glob.glob(os.path.join(clone_dir, "results*")),
+                       key=keynat)
+    print("Found %d results files in %s" % (len(filenames), clone_dir))
+
+    for loader in sorted(_traj_loaders.keys()):
+        rate = benchmark_loader(loader, filenames, top, n_repeats)
+        print("%-8s %8.2f results files/sec" % (loader, rate))
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+#!/bin/env python
+from __future__ import print_function
+import os
+import re
+import sqlite3
+from msmbuilder.dataset import _keynat as keynat
+"""
+Per protein sqlite manifest recording how far every RUN/CLONE has been
+converted. Lets re-runs of extract_project_wrapper skip finished clones
+without opening their HDF5 files.
+"""
+
+_manifest_name = "conversion_manifest.db"
+
+#results-<gen>.tar.bz2 tarballs and results<gen> folders, backups such as
+#results-000.tar.bz2.0 are no generation of their own
+_generation_pattern = re.compile(r"^results(?:-(\d+)\.tar\.bz2|(\d+))$")
+
+_create_table = """
+CREATE TABLE IF NOT EXISTS clones (
+    proj TEXT,
+    run INTEGER,
+    clone INTEGER,
+    last_gen INTEGER,
+    n_results INTEGER,
+    results_mtime REAL,
+    protein_only INTEGER,
+    PRIMARY KEY (proj, run, clone)
+)
+"""
+
+
+def _manifest_path(protein_folder):
+    return os.path.join(protein_folder, _manifest_name)
+
+
+def _connect(protein_folder):
+    conn = sqlite3.connect(_manifest_path(protein_folder))
+    conn.execute(_create_table)
+    return conn
+
+
+def results_generation(filename):
+    """
+    :param filename: path of a results* entry
+    :return: the generation it holds or None for backups and other files
+    """
+    match = _generation_pattern.match(os.path.basename(filename))
+    if match is None:
+        return None
+    return int(match.group(1) or match.group(2))
+
+
+def _entry_size(entry):
+    """
+    :param entry: os.DirEntry of a results* file or folder
+    :return: size in bytes of the entry(sum of its files for folders)
+    """
+    if entry.is_dir():
+        return sum([e.stat().st_size for e in os.scandir(entry.path)
+                    if e.is_file()])
+    return entry.stat().st_size
+
+
+def list_results(clone_folder):
+    """
+    :param clone_folder: The CLONE folder
+    :return: list of (path, generation, size in bytes, mtime) for every
+    results* entry of the clone in natural order of the paths. generation
+    is None for backups(see results_generation).
+    """
+    if not os.path.isdir(clone_folder):
+        return []
+    results = [(os.path.join(clone_folder, e.name),
+                results_generation(e.name), _entry_size(e), e.stat().st_mtime)
+               for e in os.scandir(clone_folder)
+               if e.name.startswith("results")]
+    return sorted(results, key=lambda r: keynat(r[0]))
+
+
+def scan_clone(clone_folder):
+    """
+    :param clone_folder: The CLONE folder
+    :return: number of results* entries, the latest mtime amongst them and
+    the highest generation present(-1 if there is none)
+    """
+    results = list_results(clone_folder)
+    if len(results) == 0:
+        return 0, 0.0, -1
+    generations = [gen for _, gen, _, _ in results if gen is not None]
+    return (len(results), max([mtime for _, _, _, mtime in results]),
+            max(generations) if generations else -1)
+
+
+def load_manifest(protein_folder, proj):
+    """
+    :param protein_folder: The protein folder holding the manifest
+    :param proj: The project name
+    :return: dictionary keyed on (run, clone) with the manifest entries
+    """
+    if not os.path.isfile(_manifest_path(protein_folder)):
+        return {}
+    conn = _connect(protein_folder)
+    try:
+        rows = conn.execute("SELECT run, clone, last_gen, n_results, "
+                            "results_mtime, protein_only FROM clones "
+                            "WHERE proj=?", (proj,)).fetchall()
+    finally:
+        conn.close()
+    manifest = {}
+    for run, clone, last_gen, n_results, results_mtime, protein_only in rows:
+        manifest[(run, clone)] = {"last_gen": last_gen,
+                                  "n_results": n_results,
+                                  "results_mtime": results_mtime,
+                                  "protein_only": bool(protein_only)}
+    return manifest
+
+
+def clone_is_current(entry, n_results, results_mtime, protein_only,
+                     last_gen=None):
+    """
+    :param entry: The clone's manifest entry(or None)
+    :param n_results: Current number of results* entries for the clone
+    :param results_mtime: Current latest mtime of those entries
+    :param protein_only: Whether only the stripped trajectory is wanted
+    :param last_gen: Highest generation now present(see scan_clone).
+    Defaults to n_results - 1, for clones without backup files.
+    :return: True if the clone has nothing new to convert
+    """
+    if entry is None:
+        return False
+    #a protein only pass does not cover the full trajectories
+    if entry["protein_only"] and not protein_only:
+        return False
+    if last_gen is None:
+        last_gen = n_results - 1
+    #backups count as results* entries but are no generation
+    return (entry["n_results"] == n_results and
+            entry["last_gen"] >= last_gen and
+            results_mtime <= entry["results_mtime"])
+
+
+def update_manifest(protein_folder, records):
+    """
+    :param protein_folder: The protein folder holding the manifest
+    :param records: list of (proj, run, clone, last_gen, n_results,
+    results_mtime, protein_only) tuples as returned by hdf5_concatenate
+    :return:
+    """
+    conn = _connect(protein_folder)
+    try:
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO clones VALUES "
+                             "(?, ?, ?, ?, ?, ?, ?)",
+                             [(proj, run, clone, last_gen, n_results,
+                               results_mtime, int(protein_only))
+                              for proj, run, clone, last_gen, n_results,
+                                  results_mtime, protein_only in records])
+    finally:
+        conn.close()
+    return
@@ -0,0 +1,255 @@
+#!/bin/env python
+from __future__ import print_function, division
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import tables
+from .data_loader import load_yaml_file
+from .convert_project import load_results, sanity_tests, \
+    run_conversion_jobs
+from .conversion_manifest import list_results
+"""
+Planning mode for the FAH conversion. Walks the RUN/CLONE tree of a series,
+compares it against the converted hdf5 files and reports how much work is
+pending per protein, project, run and clone, along with an estimated wall
+time. The resulting job list can be handed straight to run_plan.
+"""
+
+_report_columns = ["protein", "proj", "run", "clone", "n_results",
+                   "n_pending", "pending_bytes", "done_bytes", "done_frames",
+                   "pending_frames", "est_seconds"]
+
+
+def _numbered_dirs(folder, prefix):
+    """
+    :param folder: The folder to scan
+    :param prefix: RUN or CLONE
+    :return: sorted list of the numbers of the prefix<number> subfolders
+    """
+    pattern = re.compile(r"^%s(\d+)$"%prefix)
+    numbers = []
+    for entry in os.scandir(folder):
+        match = pattern.match(entry.name)
+        if match and entry.is_dir():
+            numbers.append(int(match.group(1)))
+    return sorted(numbers)
+
+
+def _read_progress(filename):
+    """
+    :param filename: a converted hdf5 file
+    :return: set of processed results filenames and the number of frames
+    """
+    if not os.path.isfile(filename):
+        return set(), 0
+    with tables.open_file(filename, mode="r") as f:
+        processed = set(f.root.processed_filenames[:]) \
+            if "processed_filenames" in f.root else set()
+        n_frames = 0
+        for name in ["quantized_coordinates", "coordinates"]:
+            if name in f.root:
+                n_frames = len(f.get_node("/", name))
+    return processed, n_frames
+
+
+def _scan_clone(scan_tuple):
+    """
+    :param scan_tuple: (protein, protein_folder, proj, proj_folder, run,
+    clone, protein_only)
+    :return: report row for the clone and the results files still pending
+    """
+    protein, protein_folder, proj, proj_folder, run, clone, \
+        protein_only = scan_tuple
+    #same path form as hdf5_concatenate so that names match processed ones
+    results = list_results(os.path.join(proj_folder,
+                                        "RUN%d/CLONE%d/"%(run, clone)))
+
+    out_name = "%s_%d_%d.hdf5"%(proj, run, clone)
+    processed, done_frames = _read_progress(
+        os.path.join(protein_folder, "protein_traj", out_name))
+    if not protein_only:
+        full_processed, _ = _read_progress(
+            os.path.join(protein_folder, "trajectories", out_name))
+        processed = processed.intersection(full_processed)
+
+    pending = []
+    done_bytes = 0
+    for filename, generation, size, _ in results:
+        if filename.encode() in processed:
+            done_bytes += size
+        #backup tarballs are never converted
+        elif generation is not None:
+            pending.append((filename, size))
+
+    row = {"protein": protein, "proj": proj, "run": run, "clone": clone,
+           "n_results": len(results), "n_pending": len(pending),
+           "pending_bytes": sum([size for _, size in pending]),
+           "done_bytes": done_bytes, "done_frames": done_frames}
+    return row, pending
+
+
+def measure_throughput(pending, loader="tar", n_samples=2):
+    """
+    Times the loading of a few pending results files, which dominates the
+    conversion cost.
+    :param pending: list of (filename, size, top_file) tuples
+    :param loader: "tar" or "stream" as in hdf5_concatenate
+    :param n_samples: Number of results files to time
+    :return: bytes converted per second by a single worker or None if there
+    was nothing to sample
+    """
+    total_bytes = 0
+    total_time = 0.0
+    #spread the samples over the whole size range
+    pending = sorted(pending, key=lambda p: p[1])
+    indices = np.unique(np.linspace(0, len(pending) - 1,
+                                    min(n_samples, len(pending))).astype(int))
+    for index in indices:
+        filename, size, top_file = pending[index]
+        start = time.time()
+        try:
+            load_results(filename, top_file, loader)
+        except Exception as e:
+            print("Could not sample %s: %s"%(filename, e))
+            continue
+        total_time += time.time() - start
+        total_bytes += size
+    if total_bytes == 0 or total_time <= 0:
+        return None
+    return total_bytes / total_time
+
+
+def plan_conversion(yaml_file, protein_list=None, protein_only=False,
+                    n_threads=8, throughput=None, n_samples=2, **conv_opts):
+    """
+    Walks the RUN/CLONE tree of the series in parallel and compares it
+    against the existing hdf5 outputs.
+    :param yaml_file: The yaml file to work with
+    :param protein_list: list of proteins, if None then all
+    the proteins in yaml_file["protein_list"] are planned
+    :param protein_only: Plan for protein only conversion
+    :param n_threads: Number of threads scanning the tree
+    :param throughput: Bytes per second a single worker converts. If None,
+    it is measured by loading n_samples pending results files.
+    :param n_samples: Number of results files to time when measuring
+    :param conv_opts: conversion options for hdf5_concatenate, e.g. loader
+    :return: a pandas dataframe with one row per clone and the list of
+    hdf5_concatenate jobs for the clones with pending results, in the same
+    order as the rows with n_pending > 0
+    """
+    yaml_file = load_yaml_file(yaml_file)
+    base_dir = yaml_file["base_dir"]
+    if protein_list is None:
+        protein_list = yaml_file["protein_list"]
+    if conv_opts.get("feat") is not None:
+        conv_opts.setdefault("feature_dir", yaml_file["feature_dir"])
+
+    projects = []
+    for protein in protein_list:
+        protein_folder = os.path.join(base_dir, protein)
+        for proj in yaml_file["project_dict"][protein]:
+            proj_folder = os.path.join(protein_folder, proj)
+            #planning only reads, the output folders are left to the
+            #conversion
+            top_folder = os.path.join(proj_folder, "topologies")
+            if not os.path.isdir(top_folder):
+                raise IOError("Topologies folder %s doesn't exist"%top_folder)
+            projects.append((protein, protein_folder, proj, proj_folder))
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        runs = list(executor.map(lambda p: _numbered_dirs(p[3], "RUN"),
+                                 projects))
+        run_tuples = [p + (run,) for p, p_runs in zip(projects, runs)
+                      for run in p_runs]
+        clones = list(executor.map(
+            lambda r: _numbered_dirs(os.path.join(r[3], "RUN%d"%r[4]),
+                                     "CLONE"), run_tuples))
+        scan_tuples = [r + (clone, protein_only)
+                       for r, r_clones in zip(run_tuples, clones)
+                       for clone in r_clones]
+        scanned = list(executor.map(_scan_clone, scan_tuples))
+
+    report = pd.DataFrame([row for row, _ in scanned],
+                          columns=_report_columns)
+
+    #frames per byte of the already converted results of each project
+    rates = report.groupby(["protein", "proj"])[["done_frames",
+                                                 "done_bytes"]].sum()
+    frames_per_byte = (rates.done_frames /
+                       rates.done_bytes.replace(0, np.nan)).to_dict()
+    report["pending_frames"] = [
+        frames_per_byte.get((p, j), np.nan) * b for p, j, b in
+        zip(report.protein, report.proj, report.pending_bytes)]
+
+    if throughput is None:
+        samples = [(filename, size, os.path.join(s[3], "topologies",
+                                                 "%d.pdb"%s[4]))
+                   for s, (_, pending) in zip(scan_tuples, scanned)
+                   for filename, size in pending]
+        throughput = measure_throughput(samples,
+                                        conv_opts.get("loader", "tar"),
+                                        n_samples)
+    if throughput is not None:
+        report["est_seconds"] = report.pending_bytes / throughput
+
+    jobs = [(s[2], s[1], s[3], os.path.join(s[3], "topologies"), s[4], s[5],
+             protein_only, conv_opts)
+            for s, (row, _) in zip(scan_tuples, scanned)
+            if row["n_pending"] > 0]
+
+    for level in [["protein"], ["protein", "proj"]]:
+        print(summarize_plan(report, level))
+    return report, jobs
+
+
+def summarize_plan(report, level=("protein",)):
+    """
+    :param report: dataframe returned by plan_conversion
+    :param level: columns to group on, any of protein, proj, run and clone
+    :return: dataframe of the pending work summed over each group
+    """
+    columns = ["n_results", "n_pending", "pending_bytes", "pending_frames",
+               "est_seconds"]
+    return report.groupby(list(level))[columns].sum(min_count=1)
+
+
+def estimate_wall_time(report, n_workers=1):
+    """
+    :param report: dataframe returned by plan_conversion
+    :param n_workers: Number of engines or pool processes
+    :return: estimated seconds for the whole plan with the largest first
+    scheduling of run_conversion_jobs
+    """
+    est_seconds = report.est_seconds.dropna()
+    if len(est_seconds) == 0:
+        return np.nan
+    return max(est_seconds.sum() / n_workers, est_seconds.max())
+
+
+def run_plan(report, jobs, view, use_manifest=False):
+    """
+    Dispatches the jobs of a plan without rescanning the tree.
+    :param report: dataframe returned by plan_conversion, its pending bytes
+    order the jobs. It can be sorted or hold other clones too.
+    :param jobs: job list returned by plan_conversion, or a subset of it
+    :param view: ipython view or pool view to parallelize over.
+    :param use_manifest: Record the outcome in the conversion manifests
+    :return: list of per clone records from hdf5_concatenate
+    """
+    pending_bytes = dict(zip(zip(report.protein, report.proj, report.run,
+                                 report.clone), report.pending_bytes))
+    sizes = []
+    for job in jobs:
+        key = (os.path.basename(job[1]), job[0], job[4], job[5])
+        if key not in pending_bytes:
+            raise ValueError("The report has no row for RUN%d CLONE%d of "
+                             "%s/%s"%(job[4], job[5], key[0], job[0]))
+        sizes.append(pending_bytes[key])
+    #planning leaves the output folders to the conversion
+    for protein_folder, proj_folder, top_folder in \
+            set([job[1:4] for job in jobs]):
+        sanity_tests(protein_folder, proj_folder, top_folder)
+    return run_conversion_jobs(jobs, view, use_manifest, job_sizes=sizes)
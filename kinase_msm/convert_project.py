@@ -1,21 +1,172 @@
 #!/bin/env python
 from __future__ import print_function, division
 import os
+import io
 import glob
 import tarfile
-from msmbuilder.dataset import _keynat as keynat
+import tempfile
+import shutil
+import itertools
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.pool import Pool
+try:
+    from ipyparallel import DirectView
+except ImportError:
+    DirectView = None
+import tables
 from mdtraj.formats.hdf5 import HDF5TrajectoryFile
 from mdtraj.utils import six
 import mdtraj as md
+import numpy as np
 import subprocess
-from mdtraj.utils.contextmanagers import enter_temp_directory
+from mdtraj.core.residue_names import _SOLVENT_TYPES
 from .data_loader import load_yaml_file
+from .featurize_project import FeatureAppender
+from .conversion_manifest import scan_clone, load_manifest, \
+    clone_is_current, update_manifest, results_generation, list_results
 import warnings
 
+def _complib_available(complib):
+    """
+    :param complib: pytables compression library name, e.g. blosc:lz4
+    :return: whether pytables was built with it
+    """
+    try:
+        return tables.which_lib_version(complib) is not None
+    except ValueError:
+        return False
+
+
+class TunedHDF5TrajectoryFile(HDF5TrajectoryFile):
+    """
+    HDF5TrajectoryFile with a configurable compression filter and chunk
+    shape for the arrays it creates, and an optional fixed precision
+    coordinate storage. The defaults match HDF5TrajectoryFile.
+    """
+    def __init__(self, filename, mode='r', force_overwrite=True,
+                 chunk_frames=None, complib="zlib", complevel=1,
+                 precision=None):
+        """
+        :param filename: The hdf5 file
+        :param mode: One of r, w or a
+        :param force_overwrite: Overwrite the file in w mode
+        :param chunk_frames: Number of frames per HDF5 chunk for the per frame
+        arrays. Defaults to None which lets pytables pick.
+        :param complib: Compression library, e.g. zlib, blosc:lz4 or None for
+        no compression
+        :param complevel: Compression level(0-9)
+        :param precision: If set, new files store the coordinates as int32
+        multiples of 1/precision nm in a quantized_coordinates array
+        instead of float32. 1000 matches the xtc precision. Files that
+        already hold coordinates keep their format. With zlib the files are
+        about 40% smaller than float32 ones, see
+        devtools/benchmarks/benchmark_hdf5_storage.py.
+        """
+        #checked before the file is opened, so no empty file is left behind
+        if complib is not None and not _complib_available(complib):
+            raise ValueError("Compression library %s is not available"
+                             %complib)
+        super(TunedHDF5TrajectoryFile, self).__init__(filename, mode=mode,
+                                                      force_overwrite=force_overwrite)
+        self._chunk_frames = chunk_frames
+        self._precision = precision
+        if complib is None:
+            self._handle.filters = self.tables.Filters(complevel=0)
+        else:
+            self._handle.filters = self.tables.Filters(complib=complib,
+                                                       complevel=complevel,
+                                                       shuffle=True)
+
+    @property
+    def _create_earray(self):
+        create_earray = self._handle.create_earray
+        chunk_frames = self._chunk_frames
+
+        def _create(where, name, atom, shape, **kwargs):
+            if chunk_frames is not None and name != "processed_filenames":
+                kwargs.setdefault("chunkshape",
+                                  (chunk_frames,) + tuple(shape[1:]))
+            return create_earray(where, name, atom, shape, **kwargs)
+        return _create
+
+    def _is_quantized(self):
+        root = self._handle.root
+        if "quantized_coordinates" in root:
+            return True
+        if "coordinates" in root:
+            return False
+        return self._precision is not None
+
+    def write(self, coordinates, time=None, cell_lengths=None,
+              cell_angles=None):
+        """
+        Appends frames, quantizing the coordinates if the file uses fixed
+        precision storage. The quantized values are absolute rather than
+        frame to frame deltas so that single frames can still be read
+        without decoding the rest of the file.
+        """
+        if not self._is_quantized():
+            return super(TunedHDF5TrajectoryFile, self).write(
+                coordinates, time=time, cell_lengths=cell_lengths,
+                cell_angles=cell_angles)
+
+        coordinates = np.asarray(coordinates, dtype=np.float32)
+        if coordinates.ndim == 2:
+            coordinates = coordinates[np.newaxis]
+        root = self._handle.root
+        if "quantized_coordinates" not in root:
+            self._initialize_headers(n_atoms=coordinates.shape[1],
+                                     set_coordinates=False,
+                                     set_time=(time is not None),
+                                     set_cell=(cell_lengths is not None),
+                                     set_velocities=False,
+                                     set_kineticEnergy=False,
+                                     set_potentialEnergy=False,
+                                     set_temperature=False,
+                                     set_alchemicalLambda=False)
+            self._create_earray(where='/', name='quantized_coordinates',
+                                atom=self.tables.Int32Atom(),
+                                shape=(0, coordinates.shape[1], 3))
+            root.quantized_coordinates.attrs["units"] = "nanometers"
+            root.quantized_coordinates.attrs["precision"] = self._precision
+            self._needs_initialization = False
+
+        precision = root.quantized_coordinates.attrs["precision"]
+        root.quantized_coordinates.append(
+            np.round(coordinates * precision).astype(np.int32))
+        if time is not None:
+            root.time.append(np.asarray(time, dtype=np.float32).reshape(-1))
+        if cell_lengths is not None:
+            root.cell_lengths.append(np.asarray(cell_lengths,
+                                                dtype=np.float32).reshape(-1, 3))
+            root.cell_angles.append(np.asarray(cell_angles,
+                                               dtype=np.float32).reshape(-1, 3))
+        self._frame_index += coordinates.shape[0]
+        self.flush()
+
+
 class HDF5TrajectoryFileWrapper():
-    def __init__(self,file):
+    def __init__(self,file, block_size=None):
+        """
+        :param file: The HDF5TrajectoryFile to wrap
+        :param block_size: Number of frames per append in write_file.
+        Defaults to None which appends each trajectory chunk in one call.
+        """
         assert isinstance(file, HDF5TrajectoryFile)
         self.file = file
+        self.block_size = block_size
+        self._processed = None
+
+    @property
+    def processed(self):
+        """
+        In-memory set mirroring the processed_filenames array. It is read
+        once when first needed and kept in sync by write_file.
+        """
+        if self._processed is None:
+            self._processed = set(self.file._handle.root.processed_filenames[:])
+        return self._processed
 
     def setup(self, prt_top):
         """
@@ -50,11 +201,9 @@ class HDF5TrajectoryFileWrapper():
 
             exp1_min_1 = os.path.join(f_path,"results-%.3d.tar.bz2"%(index-1))
             exp2_min_1 = os.path.join(f_path,"results%d"%(index-1))
-            return ((six.b(exp1_min_1) in
-                     self.file._handle.root.processed_filenames and
+            return ((six.b(exp1_min_1) in self.processed and
                      exp1==filename) or
-                    (six.b(exp2_min_1) in
-                   self.file._handle.root.processed_filenames) and
+                    (six.b(exp2_min_1) in self.processed) and
                     exp2==filename)
 
     def check_filename(self,filename):
@@ -64,26 +213,47 @@ class HDF5TrajectoryFileWrapper():
         :param hdf5_file: the hdf5 file
         :return:
         """
-        return six.b(filename) in self.file._handle.root.processed_filenames
+        return six.b(filename) in self.processed
 
     def write_file(self,filename,trj):
-        for frame in trj:
-            self.file.write(coordinates=frame.xyz,
-                       cell_lengths=frame.unitcell_lengths,
-                       cell_angles=frame.unitcell_angles)
+        """
+        Appends a trajectory chunk and marks its source as processed.
+        :param filename: The filename, or list of filenames, the chunk came from
+        :param trj: The trajectory chunk
+        :return:
+        """
+        block_size = self.block_size or max(trj.n_frames, 1)
+        for start in range(0, trj.n_frames, block_size):
+            stop = start + block_size
+            self.file.write(coordinates=trj.xyz[start:stop],
+                            cell_lengths=_slice_or_none(trj.unitcell_lengths,
+                                                        start, stop),
+                            cell_angles=_slice_or_none(trj.unitcell_angles,
+                                                       start, stop))
+        if isinstance(filename, (list, tuple)):
+            filenames = list(filename)
+        else:
+            filenames = [filename]
         self.file._handle.\
-                 root.processed_filenames.append([filename])
+                 root.processed_filenames.append(filenames)
+        self.processed.update(six.b(f) for f in filenames)
         return
 
 
-def _sanity_tests(protein_folder, proj_folder, top_folder):
+def _slice_or_none(arr, start, stop):
+    if arr is None:
+        return None
+    return arr[start:stop]
+
+
+def sanity_tests(protein_folder, proj_folder, top_folder):
     """
     :param proj_folder: The project folder for a protein
     :param top_folder: The topology folder for a protein
     :return:
     """
     if not os.path.isdir(top_folder):
-        sys.exit("Toplogies Folder Doesnt exist.Exiting!")
+        raise IOError("Topologies folder %s doesn't exist"%top_folder)
 
     if not os.path.isdir(os.path.join(protein_folder,"trajectories")):
         print("Trajectories folder doesnt exist.Creating")
@@ -96,12 +266,40 @@ def _sanity_tests(protein_folder, proj_folder, top_folder):
     return
 
 
-def _traj_loader(filename, top):
+def _load_xtc(filename, top, atom_indices=None):
+    """
+    :param filename: path to the xtc file
+    :param top: The topology of the atoms that are read
+    :param atom_indices: Only read these atoms. Coordinates of the other
+    atoms are never held for more than one read chunk.
+    :return: the trajectory obj
+    """
+    with md.formats.XTCTrajectoryFile(filename) as f:
+        xyz, time, step, box = f.read(atom_indices=atom_indices)
+    trj = md.Trajectory(xyz=xyz, topology=getattr(top, "topology", top),
+                        time=time)
+    trj.unitcell_vectors = box
+    return trj
+
+
+def _traj_loader(filename, top, atom_indices=None):
+    """
+    :param filename: results folder or results-*.tar.bz2 file
+    :param top: The topology of the atoms that are read
+    :param atom_indices: Only read these atoms from the xtc file
+    :return: the trajectory obj
+    """
     if os.path.isdir(filename):
-        return md.load("%s/positions.xtc"%filename, top=top)
+        return _load_xtc("%s/positions.xtc"%filename, top, atom_indices)
     elif filename.endswith(".bz2"):
-        subprocess.call(["tar", "-xjf", "%s"%filename])
-        return md.load("positions.xtc", top=top)
+        #private temp dir instead of chdir so that this is thread safe
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            subprocess.call(["tar", "-xjf", "%s"%filename], cwd=tmp_dir)
+            return _load_xtc(os.path.join(tmp_dir, "positions.xtc"), top,
+                             atom_indices)
+        finally:
+            shutil.rmtree(tmp_dir)
     elif filename.endswith(".bz2.0"):
         warnings.warn("Found backup filename %s"%filename)
     else:
@@ -109,6 +307,137 @@ def _traj_loader(filename, top):
     return
 
 
+def _load_xtc_buffer(buffer, top, atom_indices=None):
+    """
+    Parses an in-memory xtc file.
+    :param buffer: bytes of the xtc file
+    :param top: The topology of the atoms that are read
+    :param atom_indices: Only read these atoms
+    :return: the trajectory obj
+    The xtc reader needs a path, so on linux the buffer is handed over
+    through an anonymous memory file instead of touching the disk.
+    """
+    if hasattr(os, "memfd_create"):
+        fd = os.memfd_create("positions.xtc")
+        try:
+            with io.open(fd, "wb", closefd=False) as fh:
+                fh.write(buffer)
+            return _load_xtc("/proc/self/fd/%d"%fd, top, atom_indices)
+        finally:
+            os.close(fd)
+    with tempfile.NamedTemporaryFile(suffix=".xtc") as fh:
+        fh.write(buffer)
+        fh.flush()
+        return _load_xtc(fh.name, top, atom_indices)
+
+
+def _traj_loader_stream(filename, top, atom_indices=None):
+    """
+    Loads a results file without shelling out to tar. The tarball is
+    decompressed in-process and only positions.xtc is pulled out of it.
+    :param filename: results folder or results-*.tar.bz2 file
+    :param top: The topology of the atoms that are read
+    :param atom_indices: Only read these atoms from the xtc file
+    :return: the trajectory obj
+    """
+    if not filename.endswith(".bz2"):
+        return _traj_loader(filename, top, atom_indices)
+    with tarfile.open(filename, mode="r|bz2") as tar:
+        for member in tar:
+            if os.path.basename(member.name) == "positions.xtc":
+                return _load_xtc_buffer(tar.extractfile(member).read(), top,
+                                        atom_indices)
+    raise Exception("Could not find positions.xtc in %s"%filename)
+
+
+_traj_loaders = {"tar": _traj_loader,
+                 "stream": _traj_loader_stream}
+
+
+def load_results(filename, top_file, loader="tar"):
+    """
+    :param filename: a results tarball or folder
+    :param top_file: the topology pdb of the run
+    :param loader: "tar" or "stream" as in hdf5_concatenate
+    :return: the trajectory of the results file with all atoms
+    """
+    return _traj_loaders[loader](filename, _load_topology(top_file)[0])
+
+
+#worker local cache of parsed topologies keyed on the pdb path
+_topology_cache = {}
+
+
+def _load_topology(top_file):
+    """
+    Parses a run's pdb once per worker.
+    :param top_file: path to the pdb file
+    :return: the full topology trajectory, the solvent stripped topology
+    trajectory and the indices of the non-solvent atoms
+    """
+    top_file = os.path.abspath(top_file)
+    if top_file not in _topology_cache:
+        top = md.load(top_file)
+        prot_indices = np.array([a.index for a in top.topology.atoms
+                                 if a.residue.name not in _SOLVENT_TYPES])
+        str_top = top.atom_slice(prot_indices)
+        _topology_cache[top_file] = (top, str_top, prot_indices)
+    return _topology_cache[top_file]
+
+
+def _strip_solvent(trj, str_top, prot_indices):
+    """
+    Equivalent of trj.remove_solvent() that reuses precomputed indices
+    and the stripped topology instead of rebuilding them.
+    """
+    return md.Trajectory(xyz=trj.xyz[:, prot_indices],
+                         topology=str_top.topology,
+                         time=trj.time,
+                         unitcell_lengths=trj.unitcell_lengths,
+                         unitcell_angles=trj.unitcell_angles)
+
+
+def _try_call(func, item):
+    try:
+        return func(item)
+    except Exception as e:
+        return e
+
+
+def _ordered_prefetch(func, items, n_prefetch=0):
+    """
+    Yields (item, func(item)) for every item in order. With n_prefetch > 0
+    up to n_prefetch items are processed ahead of the consumer by a thread
+    pool, so at most n_prefetch results are held in memory at once.
+    Exceptions raised by func are yielded as the result.
+    :param func: function to call on every item
+    :param items: iterable of items
+    :param n_prefetch: number of items to work on ahead of the consumer
+    """
+    if n_prefetch <= 0:
+        for item in items:
+            yield item, _try_call(func, item)
+        return
+
+    executor = ThreadPoolExecutor(max_workers=n_prefetch)
+    items = iter(items)
+    window = collections.deque()
+    try:
+        for item in itertools.islice(items, n_prefetch):
+            window.append((item, executor.submit(_try_call, func, item)))
+        while window:
+            item, future = window.popleft()
+            result = future.result()
+            for next_item in itertools.islice(items, 1):
+                window.append((next_item,
+                               executor.submit(_try_call, func, next_item)))
+            yield item, result
+    finally:
+        for _, future in window:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
 def hdf5_concatenate(job_tuple):
     """Concatenate tar bzipped or nonbized XTC files created by Folding@Home .
     Parameters
@@ -119,81 +448,162 @@ def hdf5_concatenate(job_tuple):
         Topology for system
     output_filename : str
         Filename of output HDF5 file to generate.
+    conv_opts : dict
+        Optional dictionary of conversion options passed as the last element
+        of the job tuple. "loader" picks how results files are read, either
+        "tar"(default, shells out to tar) or "stream"(in-process).
+        "block_size" is the number of frames per HDF5 append(defaults to
+        the whole results file). "prefetch" is the number of results files
+        loaded ahead of the writer by a thread pool(defaults to 0, serial).
+        "chunk_frames", "complib" and "complevel" set the HDF5 chunking and
+        compression of newly created output files and "precision" turns
+        on fixed precision coordinates for new protein_traj files(see
+        TunedHDF5TrajectoryFile). "feat" featurizes the new stripped
+        frames as they are written(a featurizer or a dictionary of them as
+        in featurize_project_wrapper), with "feature_dir" the default feature
+        folder and "feat_stride" the featurization stride(see
+        FeatureAppender).
+    Returns
+    -------
+    record : tuple
+        (proj, run, clone, last_gen, n_results, results_mtime, protein_only)
+        where last_gen is the last generation that has been
+        contiguously converted. Used to update the conversion manifest.
     Notes
     -----
     We use HDF5 because it provides an easy way to store the metadata associated
     with which files have already been processed.
     """
 
-    proj, protein_folder, proj_folder, top_folder, run, clone, protein_only = job_tuple
+    proj, protein_folder, proj_folder, top_folder, run, clone, protein_only = job_tuple[:7]
+    conv_opts = job_tuple[7] if len(job_tuple) > 7 else {}
+    traj_loader = _traj_loaders[conv_opts.get("loader", "tar")]
+    block_size = conv_opts.get("block_size", None)
+    prefetch = conv_opts.get("prefetch", 0)
+    storage_opts = dict((k, conv_opts[k]) for k in
+                        ["chunk_frames", "complib", "complevel"]
+                        if k in conv_opts)
 
     path = os.path.join(proj_folder,"RUN%d/CLONE%d/"%(run,clone))
-    top = md.load(os.path.join(top_folder,"%d.pdb"%run))
-    str_top = top.remove_solvent()
-
+    n_results, results_mtime, _ = scan_clone(path)
 
-    glob_input = os.path.join(path, "results*")
-    filenames = sorted(glob.glob(glob_input), key=keynat)
+    filenames = [filename for filename, _, _, _ in list_results(path)]
 
     if len(filenames) <= 0:
-        return
+        return (proj, run, clone, -1, 0, results_mtime, protein_only)
+
+    top, str_top, prot_indices = _load_topology(os.path.join(top_folder,
+                                                             "%d.pdb"%run))
 
     #output path for stripped trajectory
     strip_prot_out_filename = os.path.join(protein_folder,
                                            "protein_traj/%s_%d_%d.hdf5"%(proj,run,clone))
-    str_trj_file = HDF5TrajectoryFile(strip_prot_out_filename, mode='a')
-    str_trj_file_wrapper = HDF5TrajectoryFileWrapper(str_trj_file)
+    #catches up on existing frames, so it has to come before the file is opened
+    appender = None
+    if conv_opts.get("feat") is not None:
+        appender = FeatureAppender({"base_dir": os.path.dirname(protein_folder),
+                                    "feature_dir": conv_opts.get("feature_dir")},
+                                   os.path.basename(protein_folder),
+                                   strip_prot_out_filename, conv_opts["feat"],
+                                   conv_opts.get("feat_stride", 1))
+    str_trj_file = TunedHDF5TrajectoryFile(strip_prot_out_filename, mode='a',
+                                           precision=conv_opts.get("precision"),
+                                           **storage_opts)
+    str_trj_file_wrapper = HDF5TrajectoryFileWrapper(str_trj_file, block_size)
     str_trj_file_wrapper.setup(str_top.topology)
 
     if not protein_only:
         #output path for full trajectory
         output_filename =  os.path.join(protein_folder,
                                     "trajectories/%s_%d_%d.hdf5"%(proj,run,clone))
-        trj_file = HDF5TrajectoryFile(output_filename, mode='a')
-        trj_file_wrapper = HDF5TrajectoryFileWrapper(trj_file)
+        trj_file = TunedHDF5TrajectoryFile(output_filename, mode='a',
+                                           **storage_opts)
+        trj_file_wrapper = HDF5TrajectoryFileWrapper(trj_file, block_size)
         trj_file_wrapper.setup(top.topology)
 
 
+    to_process = []
     for index, filename in enumerate(filenames):
+        #backup tarballs are never converted
+        if results_generation(filename) is None:
+            continue
         #if we find it in both then no problem we can continue to the next filename
         if ( protein_only or trj_file_wrapper.check_filename(filename)) and \
                 str_trj_file_wrapper.check_filename(filename):
             print("Already processed %s" % filename)
             continue
-        with enter_temp_directory():
-            print("Processing %s" % filename)
-            #try loading the file
-            try:
-                trj = _traj_loader(filename,top)
-            #if that fails, give up on this clone entirely and move on
-            except:
-                print("Failed at %s "%filename)
-                break
-            #if loading is successful, try adding it
-            if (not protein_only) and (not trj_file_wrapper.check_filename(filename)):
-                if trj_file_wrapper.validate_filename(index, filename, filenames):
-                    trj_file_wrapper.write_file(filename, trj)
-            #now the stripped file
-            if not str_trj_file_wrapper.check_filename(filename):
-                if str_trj_file_wrapper.validate_filename(index, filename, filenames):
-                    trj = trj.remove_solvent()
-                    str_trj_file_wrapper.write_file(filename, trj)
+        to_process.append((index, filename))
+
+    def _prepare(job):
+        index, filename = job
+        #protein only runs never read the solvent coordinates
+        if protein_only:
+            return None, traj_loader(filename, str_top, prot_indices)
+        trj = traj_loader(filename, top)
+        return trj, _strip_solvent(trj, str_top, prot_indices)
+
+    #with prefetch > 0 the next files are decompressed and parsed in
+    #background threads while the current ones are written in gen order
+    for (index, filename), result in _ordered_prefetch(_prepare, to_process,
+                                                       prefetch):
+        print("Processing %s" % filename)
+        #if loading failed, give up on this clone entirely and move on
+        if isinstance(result, Exception):
+            print("Failed at %s "%filename)
+            break
+        trj, str_trj = result
+        #if loading is successful, try adding it
+        if (not protein_only) and (not trj_file_wrapper.check_filename(filename)):
+            if trj_file_wrapper.validate_filename(index, filename, filenames):
+                trj_file_wrapper.write_file(filename, trj)
+        #now the stripped file
+        if not str_trj_file_wrapper.check_filename(filename):
+            if str_trj_file_wrapper.validate_filename(index, filename, filenames):
+                str_trj_file_wrapper.write_file(filename, str_trj)
+                if appender is not None:
+                    appender.append(str_trj)
+
+    last_gen = -1
+    for filename in filenames:
+        if results_generation(filename) is None:
+            continue
+        if not (str_trj_file_wrapper.check_filename(filename) and
+                (protein_only or trj_file_wrapper.check_filename(filename))):
+            break
+        last_gen = results_generation(filename)
 
-    return
+    str_trj_file.close()
+    if not protein_only:
+        trj_file.close()
+    if appender is not None:
+        appender.close()
 
+    return (proj, run, clone, last_gen, n_results, results_mtime, protein_only)
 
-def extract_project_wrapper(yaml_file, protein, proj,
-                            view, protein_only = False,):
 
+def _project_jobs(yaml_file, protein, proj, protein_only=False,
+                  use_manifest=False, **conv_opts):
+    """
+    :param yaml_file: The yaml file to work with
+    :param protein: Protein name
+    :param proj: Project name
+    :param protein_only: Only write the solvent stripped trajectories
+    :param use_manifest: Drop clones that the protein's conversion manifest
+    reports as fully converted with no new results since
+    :param conv_opts: conversion options for hdf5_concatenate
+    :return: list of hdf5_concatenate job tuples, one per RUN/CLONE
+    """
     yaml_file = load_yaml_file(yaml_file)
     base_dir = yaml_file["base_dir"]
+    if conv_opts.get("feat") is not None:
+        conv_opts.setdefault("feature_dir", yaml_file["feature_dir"])
 
     #get the paths
     protein_folder = os.path.join(base_dir,protein)
     proj_folder = os.path.join(protein_folder, proj)
     top_folder = os.path.join(proj_folder, "topologies")
 
-    _sanity_tests(protein_folder, proj_folder, top_folder)
+    sanity_tests(protein_folder, proj_folder, top_folder)
 
     #get the runs/clones
 
@@ -207,10 +617,122 @@ def extract_project_wrapper(yaml_file, protein, proj,
 
     print("Found %d runs in %s"%(len(runs), proj_folder))
 
-    jobs = [(proj, protein_folder, proj_folder, top_folder, run, clone, protein_only)
+    jobs = [(proj, protein_folder, proj_folder, top_folder, run, clone,
+             protein_only, conv_opts)
             for run in runs
             for clone in clones[run]]
-    result = view.map(hdf5_concatenate,jobs)
+
+    if use_manifest:
+        manifest = load_manifest(protein_folder, proj)
+        pending = []
+        for job in jobs:
+            run, clone = job[4], job[5]
+            n_results, results_mtime, last_gen = scan_clone(
+                os.path.join(proj_folder, "RUN%d/CLONE%d/"%(run, clone)))
+            if not clone_is_current(manifest.get((run, clone)), n_results,
+                                    results_mtime, protein_only, last_gen):
+                pending.append(job)
+        jobs = pending
+        print("%d clones have new results in %s"%(len(jobs), proj_folder))
+
+    return jobs
 
 
+def _job_size(job):
+    """
+    :param job: hdf5_concatenate job tuple
+    :return: total size in bytes of the clone's results* entries
+    """
+    proj_folder, run, clone = job[2], job[4], job[5]
+    path = os.path.join(proj_folder,"RUN%d/CLONE%d/"%(run,clone))
+    return sum([size for _, _, size, _ in list_results(path)])
+
+
+def _dynamic_map(view, func, jobs):
+    """
+    Maps jobs one at a time so that idle workers pick up the next job as
+    soon as they are done. multiprocessing pools otherwise hand out
+    large fixed chunks of the job list, and ipyparallel direct views split
+    it statically across the engines, so those are swapped for a load
+    balanced view on the same engines.
+    """
+    if isinstance(view, Pool):
+        return view.map(func, jobs, chunksize=1)
+    if DirectView is not None and isinstance(view, DirectView):
+        view = view.client.load_balanced_view(targets=view.targets)
+    return list(view.map(func, jobs))
+
+
+def run_conversion_jobs(jobs, view, use_manifest=False, job_sizes=None):
+    """
+    Dispatches hdf5_concatenate jobs, possibly from several proteins and
+    projects, largest clone first.
+    :param jobs: list of hdf5_concatenate job tuples
+    :param view: ipython view or pool view to parallelize over.
+    :param use_manifest: Record the outcome in the conversion manifests
+    :param job_sizes: Optional size of every job(e.g. the pending bytes from
+    convert_planner). Defaults to the size of all the clone's results.
+    :return: list of per clone records from hdf5_concatenate
+    """
+    if job_sizes is None:
+        job_sizes = [_job_size(job) for job in jobs]
+    order = sorted(range(len(jobs)), key=lambda i: job_sizes[i], reverse=True)
+    jobs = [jobs[i] for i in order]
+    result = list(_dynamic_map(view, hdf5_concatenate, jobs))
+
+    if use_manifest:
+        records = {}
+        for job, record in zip(jobs, result):
+            if record is not None:
+                records.setdefault(job[1], []).append(record)
+        for protein_folder in records.keys():
+            update_manifest(protein_folder, records[protein_folder])
+
     return result
+
+
+def extract_project_wrapper(yaml_file, protein, proj,
+                            view, protein_only = False, loader="tar",
+                            block_size=None, use_manifest=False, prefetch=0,
+                            chunk_frames=None, complib="zlib", complevel=1,
+                            precision=None, feat=None, feat_stride=1):
+    """
+    :param yaml_file: The yaml file to work with
+    :param protein: Protein name
+    :param proj: Project name
+    :param view: ipython view or pool view to parallelize over.
+    :param protein_only: Only write the solvent stripped trajectories
+    :param loader: How to read the results files. "tar" shells out to
+    tar while "stream" decompresses the tarballs in-process.
+    :param block_size: Number of frames per HDF5 append. Defaults to None
+    which appends each results file in a single call.
+    :param use_manifest: Skip clones that the protein's conversion manifest
+    reports as fully converted with no new results since, and record the
+    outcome of this pass in it.
+    :param prefetch: Number of results files each worker decompresses and
+    parses ahead of its writer, in background threads. Defaults to 0(serial).
+    :param chunk_frames: Frames per HDF5 chunk for new output files. Defaults
+    to None which lets pytables pick(one frame per chunk).
+    :param complib: Compression filter for new output files, e.g. zlib,
+    blosc:lz4 or None. Defaults to zlib.
+    :param complevel: Compression level. Defaults to 1.
+    :param precision: Store new protein_traj files with fixed precision
+    int32 coordinates(1000 keeps the xtc precision of 0.001 nm). Defaults to
+    None which stores float32. Use data_loader.load_traj/load_frame to read
+    them back.
+    :param feat: Featurization obj(or dictionary of them keyed on their
+    feature folder, see featurize_project_wrapper) applied to the new
+    stripped frames as they are converted. Features go to the same files as
+    featurize_project_wrapper with incremental=True, which later picks up
+    from where the conversion left off. Defaults to None(no featurization).
+    :param feat_stride: Only featurize every feat_stride-th frame
+    :return: list of per clone records from hdf5_concatenate
+    """
+    jobs = _project_jobs(yaml_file, protein, proj, protein_only=protein_only,
+                         use_manifest=use_manifest, loader=loader,
+                         block_size=block_size, prefetch=prefetch,
+                         chunk_frames=chunk_frames, complib=complib,
+                         complevel=complevel, precision=precision,
+                         feat=feat, feat_stride=feat_stride)
+
+    return run_conversion_jobs(jobs, view, use_manifest)
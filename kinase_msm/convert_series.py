@@ -1,14 +1,21 @@
 #!/bin/env python
 import os
-from .convert_project import extract_project_wrapper, _sanity_tests
+from .convert_project import _project_jobs, sanity_tests, \
+    run_conversion_jobs
 from .data_loader import load_yaml_file
 
-def convert_series(yaml_file, ip_view, protein_list = None):
+def convert_series(yaml_file, ip_view, protein_list = None, **kwargs):
     """
+    The jobs of all proteins and projects go into a single queue ordered
+    largest clone first, and are handed out one at a time so that no engine
+    idles while others work through a slow project. Direct views are
+    swapped for a load balanced view on the same engines to do so.
     :param yaml_file: The yaml file to work with
-    :param ip_view: ipython view(required)
+    :param ip_view: ipython view(required) or multiprocessing pool
     :param protein_list: list of proteins, if None then all
     the proteins in yaml_file["protein_list"] are processed
+    :param kwargs: conversion options as for extract_project_wrapper,
+    e.g. protein_only, use_manifest, loader, chunk_frames or complib
     :return: converted and concatenated trajectories in
     yaml_file["base_dir"]+protein_name+trajectories
     and the stripped files in
@@ -20,6 +27,7 @@ def convert_series(yaml_file, ip_view, protein_list = None):
     if protein_list is None:
         protein_list = yaml_file["protein_list"]
 
+    jobs = []
     for protein in protein_list:
         for proj in yaml_file["project_dict"][protein]:
 
@@ -27,9 +35,10 @@ def convert_series(yaml_file, ip_view, protein_list = None):
             proj_folder = os.path.join(protein_folder, proj)
             top_folder = os.path.join(proj_folder,"topologies")
 
-            _sanity_tests(protein_folder, proj_folder, top_folder)
+            sanity_tests(protein_folder, proj_folder, top_folder)
 
-            extract_project_wrapper(yaml_file, protein,
-                                    proj, ip_view)
+            jobs.extend(_project_jobs(yaml_file, protein, proj, **kwargs))
 
-    return
\ No newline at end of file
+    print("Dispatching %d clones across the series"%len(jobs))
+    return run_conversion_jobs(jobs, ip_view,
+                               kwargs.get("use_manifest", False))
\ No newline at end of file
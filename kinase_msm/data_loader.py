@@ -2,11 +2,13 @@ import os
 from msmbuilder.utils import verboseload, verbosedump
 import mdtraj as mdt
 import numpy as np
-import yaml
 import glob
 from msmbuilder.dataset import _keynat as keynat
 import contextlib
 import random
+from mdtraj.formats.hdf5 import HDF5TrajectoryFile
+from .project_yaml import load_yaml_file
+from .feature_store import load_tica_data
 
 '''
 script to load pertinent data for a given protein
@@ -42,6 +44,46 @@ def load_random_traj(yaml_file, protein):
     #need just one
     return trj
 
+
+#per protein topologies keyed on the protein's trajectory folder
+_topology_cache = {}
+
+
+def _random_traj_file(yaml_file, protein):
+    traj_folder = os.path.join(yaml_file["base_dir"], protein,
+                               yaml_file["protein_dir"])
+    traj_files = sorted(glob.glob(os.path.join(traj_folder,"*.hdf5" )),
+                        key=keynat)
+    return os.path.abspath(random.choice(traj_files))
+
+
+def load_topology(yaml_file, protein):
+    """
+    Reads only the topology of one of the protein's trajectories, once per
+    protein.
+    :param yaml_file: The yaml file to work with
+    :param protein: Protein of interest
+    :return: the protein's mdtraj topology
+    """
+    yaml_file = load_yaml_file(yaml_file)
+    key = os.path.abspath(os.path.join(yaml_file["base_dir"], protein,
+                                       yaml_file["protein_dir"]))
+    if key not in _topology_cache:
+        with HDF5TrajectoryFile(_random_traj_file(yaml_file, protein)) as f:
+            _topology_cache[key] = f.topology
+    return _topology_cache[key]
+
+
+def load_random_frame(yaml_file, protein):
+    """
+    :param yaml_file: The yaml file to work with
+    :param protein: Protein of interest
+    :return: the first frame of a random trajectory of the protein, enough
+    for describe_features
+    """
+    yaml_file = load_yaml_file(yaml_file)
+    return load_hdf5(_random_traj_file(yaml_file, protein), frame_index=0)
+
 def load_traj(base_dir, protein, traj_folder, filename):
     """
     :param base_dir: Project's base dir
@@ -52,7 +94,7 @@ def load_traj(base_dir, protein, traj_folder, filename):
     """
     os.chdir(os.path.join(base_dir, protein,traj_folder))
     filename = os.path.splitext(filename)[0]
-    return mdt.load("%s.hdf5" %filename)
+    return load_hdf5("%s.hdf5" %filename)
 
 
 def load_frame(base_dir, protein, traj_folder, filename, frame_index):
@@ -65,7 +107,112 @@ def load_frame(base_dir, protein, traj_folder, filename, frame_index):
     """
     os.chdir(os.path.join(base_dir, protein,traj_folder))
     filename = os.path.splitext(filename)[0]
-    return mdt.load_frame(filename="%s.hdf5"%filename, index=frame_index)
+    return load_hdf5("%s.hdf5"%filename, frame_index=frame_index)
+
+
+def load_hdf5(filename, stride=None, frame_index=None):
+    """
+    Loads a converted hdf5 trajectory. Files written with fixed precision
+    coordinates(see convert_project.TunedHDF5TrajectoryFile) are decoded
+    back to float32 nanometers, everything else goes through mdtraj.
+    :param filename: The hdf5 file
+    :param stride: Only load every stride-th frame
+    :param frame_index: Only load this frame
+    :return: the trajectory obj
+    """
+    with HDF5TrajectoryFile(filename) as f:
+        root = f.root
+        if "quantized_coordinates" not in root:
+            if frame_index is not None:
+                f.seek(frame_index)
+                return f.read_as_traj(n_frames=1)
+            return f.read_as_traj(stride=stride)
+
+        if frame_index is not None:
+            if frame_index < 0:
+                frame_index += len(root.quantized_coordinates)
+            frames = slice(frame_index, frame_index + 1)
+        else:
+            frames = slice(None, None, stride)
+        return _read_quantized(f, frames, f.topology)
+
+
+def _read_quantized(f, frames, topology, atom_indices=None):
+    """
+    :param f: open HDF5TrajectoryFile with quantized coordinates
+    :param frames: slice of frames to read
+    :param topology: The topology of the atoms that are read
+    :param atom_indices: Only read these atoms(sorted)
+    :return: the trajectory obj
+    """
+    root = f.root
+    node = root.quantized_coordinates
+    if atom_indices is None:
+        xyz = node[frames]
+    else:
+        xyz = node[frames, atom_indices, :]
+    xyz = xyz.astype(np.float32) / node.attrs["precision"]
+    cell_lengths = cell_angles = time = None
+    if "cell_lengths" in root:
+        cell_lengths = root.cell_lengths[frames]
+        cell_angles = root.cell_angles[frames]
+    if "time" in root:
+        time = root.time[frames]
+    return mdt.Trajectory(xyz=xyz, topology=topology, time=time,
+                          unitcell_lengths=cell_lengths,
+                          unitcell_angles=cell_angles)
+
+
+def hdf5_n_frames(filename):
+    """
+    :param filename: A converted hdf5 trajectory(either storage format)
+    :return: Number of frames in the file, without reading any coordinates
+    """
+    with HDF5TrajectoryFile(filename) as f:
+        if "quantized_coordinates" in f.root:
+            return len(f.root.quantized_coordinates)
+        return len(f.root.coordinates)
+
+
+def iterload_hdf5(filename, chunk=1000, stride=1, start=0, atom_indices=None):
+    """
+    Iterates over a converted hdf5 trajectory(either storage format) in
+    chunks so that only one chunk of coordinates is held at a time.
+    :param filename: The hdf5 file
+    :param chunk: Number of frames per yielded chunk(after striding)
+    :param stride: Only load every stride-th frame
+    :param start: First frame to load
+    :param atom_indices: Only load these atoms(sorted). The chunks then
+    carry the subset topology.
+    :return: generator of trajectory objs
+    """
+    stride = stride or 1
+    span = chunk * stride
+    with HDF5TrajectoryFile(filename) as f:
+        topology = f.topology
+        if atom_indices is not None:
+            atom_indices = np.asarray(atom_indices)
+            topology = topology.subset(atom_indices)
+        root = f.root
+        if "quantized_coordinates" in root:
+            n_frames = len(root.quantized_coordinates)
+            for chunk_start in range(start, n_frames, span):
+                yield _read_quantized(f, slice(chunk_start, chunk_start + span,
+                                               stride), topology, atom_indices)
+            return
+        if start >= len(root.coordinates):
+            return
+        f.seek(start)
+        while True:
+            #read keeps the stride phase across chunks
+            data = f.read(n_frames=span, stride=stride,
+                          atom_indices=atom_indices)
+            if len(data) == 0:
+                return
+            yield mdt.Trajectory(xyz=data.coordinates, topology=topology,
+                                 time=data.time,
+                                 unitcell_lengths=data.cell_lengths,
+                                 unitcell_angles=data.cell_angles)
 
 
 def _sanity_test(base_dir, protein, msm_mdl, tica_data, kmeans_mdl, assignments):
@@ -78,13 +225,6 @@ def _sanity_test(base_dir, protein, msm_mdl, tica_data, kmeans_mdl, assignments)
     return
 
 
-def load_yaml_file(yaml_file):
-    if isinstance(yaml_file, dict):
-        return yaml_file
-    else:
-        return yaml.load(open(yaml_file, 'r'))
-
-
 def load_current_protein_model(yaml_file, protein, sanity=True):
     """
     :param base_dir: Base directory for the project
@@ -107,7 +247,7 @@ def load_current_protein_model(yaml_file, protein, sanity=True):
     tica_mdl = verboseload(os.path.join(mdl_dir, "tica_mdl.pkl"))
 
     # now load the protein level information
-    tica_data = verboseload(os.path.join(prot_mdl_dir, "tica_data.pkl"))
+    tica_data = load_tica_data(prot_mdl_dir)
     # need the fixed assignments because otherwise we will have issues
     assignments = verboseload(os.path.join(
         prot_mdl_dir, "fixed_assignments.pkl"))
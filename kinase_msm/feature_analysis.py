@@ -1,13 +1,10 @@
 '''
 Set of scripts to make feature analysis easier.
 '''
-import glob
-import os
 import numpy as np
-from msmbuilder.utils import load
 from kinase_msm.data_loader import load_yaml_file
-from kinase_msm.data_loader import load_random_traj, \
-    enter_protein_data_dir, enter_protein_mdl_dir
+from kinase_msm.data_loader import load_random_traj, enter_protein_mdl_dir
+from kinase_msm.feature_store import iter_protein_features
 
 
 def pull_features(yaml_file, prt, skip=1, feature_indices=None):
@@ -20,9 +17,7 @@ def pull_features(yaml_file, prt, skip=1, feature_indices=None):
     """
     yaml_file = load_yaml_file(yaml_file)
     all_f ={}
-    with enter_protein_data_dir(yaml_file, prt.name):
-        feature_file_list = glob.glob("./%s/*.jl"%yaml_file["feature_dir"])
-        for i in feature_file_list:
-            all_f[os.path.basename(i)]=load(i)[:, feature_indices]
+    for i, features in iter_protein_features(yaml_file, prt.name):
+        all_f[i] = np.asarray(features[:, feature_indices])
 
     return all_f
\ No newline at end of file
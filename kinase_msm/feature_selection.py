@@ -7,8 +7,9 @@ from multiprocessing import Pool
 from msmbuilder.utils import verboseload, verbosedump
 from kinase_msm.data_loader import load_yaml_file
 from kinase_msm.featurize_project import _check_output_folder_exists
-from kinase_msm.data_loader import load_random_traj, \
-    enter_protein_data_dir, enter_protein_mdl_dir
+from kinase_msm.feature_store import open_feature_store, load_features
+from kinase_msm.data_loader import enter_protein_data_dir, \
+    enter_protein_mdl_dir, load_topology, load_random_frame
 from sklearn.base import clone
 from msmbuilder.featurizer import ContactFeaturizer,LogisticContactFeaturizer,\
     BinaryContactFeaturizer
@@ -58,16 +59,18 @@ def _present_for_all(protein, prt_mapping, prt_seq, aligned_dict):
 
 def _map_residue_ind_seq_ind(yaml_file, protein, aligned_seq, trj=None):
     if trj is None:
-        trj = load_random_traj(yaml_file, protein)
+        top = load_topology(yaml_file, protein)
+    else:
+        top = trj.top
     mapping = {}
     seq_index = 0
-    prt_seq = ''.join([i.code for i in trj.top.residues if i.is_protein])
+    prt_seq = ''.join([i.code for i in top.residues if i.is_protein])
     #test to make sure the alignment sequence matches with the protein sequence.
     #get rid of _ from the alignment to account for additions/deletions.
     assert(prt_seq==''.join([i for i in aligned_seq if i!="-"]))
-    for i in [i.index for i in trj.top.residues if i.is_protein]:
+    for i in [i.index for i in top.residues if i.is_protein]:
         while True:
-            if trj.top.residue(i).code == aligned_seq[seq_index]:
+            if top.residue(i).code == aligned_seq[seq_index]:
                 mapping[i] = seq_index
                 seq_index += 1
                 break
@@ -105,10 +108,12 @@ def _get_common_features(yaml_file, featurizer, aligned_dict,save_df=True):
         print(protein)
         #reset the featurizer
         featurizer = clone(featurizer)
-        trj = load_random_traj(yaml_file, protein)
+        #describe_features only needs one frame
+        trj = load_random_frame(yaml_file, protein)
         df = pd.DataFrame(featurizer.describe_features(trj))
         prt_mapping, prt_seq = _map_residue_ind_seq_ind(yaml_file, protein,
-                                                        aligned_dict[protein])
+                                                        aligned_dict[protein],
+                                                        trj)
         feature_vec =[]
         #for every feature
         for i in df.iterrows():
@@ -155,9 +160,10 @@ def _get_common_features(yaml_file, featurizer, aligned_dict,save_df=True):
     return result_dict, df_dict
 
 def _slice_file(job_tuple):
-    inp_file, feature_ind, output_folder = job_tuple
-    featurized_file = verboseload(inp_file)
-    sliced_file = featurized_file[:, feature_ind]
+    inp_file, feature_ind, output_folder = job_tuple[:3]
+    #the parent checked that the folder's feature store is current
+    from_store = job_tuple[3] if len(job_tuple) > 3 else False
+    sliced_file = load_features(inp_file, feature_ind, from_store)
     sliced_file_out = os.path.join(output_folder, os.path.basename(inp_file))
     verbosedump(sliced_file, sliced_file_out)
     return
@@ -173,9 +179,11 @@ def _feature_slicer(yaml_file, dict_feat_ind, folder_name, view):
         output_folder = os.path.join(yaml_file["base_dir"],
                                   protein, folder_name)
         flist = glob.glob(os.path.join(feature_folder,"*.jl"))
+        from_store = open_feature_store(feature_folder) is not None
 
         feature_ind = dict_feat_ind[protein]
-        jobs = [(inp_file, feature_ind, output_folder) for inp_file in flist]
+        jobs = [(inp_file, feature_ind, output_folder, from_store)
+                for inp_file in flist]
         view.map(_slice_file, jobs)
 
     return
@@ -0,0 +1,356 @@
+#!/bin/env python
+from __future__ import print_function
+import os
+import glob
+import uuid
+import collections
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+import numpy as np
+from msmbuilder.dataset import _keynat as keynat
+from msmbuilder.utils import verboseload, verbosedump
+from .project_yaml import load_yaml_file
+"""
+Per protein feature store. All the .jl files of a feature folder are
+consolidated into one contiguous array file(_features.<generation>.dat)
+plus an index(_index.pkl) holding the trajectory names, their row offsets
+and the generation of the data file it describes. Rewrites go to a new data
+file and the index is renamed over last, so readers always get a matching
+pair. Readers get
+memory mapped per trajectory views instead of unpickling thousands of small
+files. The .jl files stay the source of truth: a store older than any of
+them is ignored. The same format holds the tica transformed trajectories of
+every protein(<mdl_dir>/<protein>/tica_data, see load_tica_data).
+"""
+
+#data file of a store generation, older indexes have no generation
+_data_name = "_features%s.dat"
+_index_name = "_index.pkl"
+#store folder of the tica transformed trajectories in a protein's mdl dir
+_tica_data_dir = "tica_data"
+
+#worker local cache of opened stores keyed on folder and index mtime, only
+#the latest index of every folder is kept
+_store_cache = {}
+
+#default bytes of features loaded ahead of the consumer
+_prefetch_bytes = 2**30
+
+
+class FeatureStore(Mapping):
+    """
+    Read only mapping from trajectory name(the .jl basename) to a memory
+    mapped (n_frames, n_features) view of its features.
+    """
+    def __init__(self, feature_folder):
+        """
+        :param feature_folder: feature folder holding the store
+        """
+        index = verboseload(os.path.join(feature_folder, _index_name))
+        self.feature_folder = feature_folder
+        self.names = list(index["names"])
+        self.offsets = np.asarray(index["offsets"])
+        self.n_features = index["n_features"]
+        self.dtype = np.dtype(index["dtype"])
+        self.generation = index.get("generation")
+        self._positions = dict((name, i) for i, name in enumerate(self.names))
+        if self.offsets[-1] > 0:
+            self._data = np.memmap(_data_file(feature_folder,
+                                              self.generation),
+                                   dtype=self.dtype, mode='r',
+                                   shape=(int(self.offsets[-1]),
+                                          self.n_features))
+        else:
+            self._data = np.zeros((0, self.n_features), dtype=self.dtype)
+
+    def __getitem__(self, name):
+        i = self._positions[name]
+        return self._data[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def n_frames(self, name):
+        """
+        :param name: trajectory name
+        :return: number of frames of the trajectory
+        """
+        i = self._positions[name]
+        return int(self.offsets[i + 1] - self.offsets[i])
+
+    def read(self, name, columns=None):
+        """
+        :param name: trajectory name
+        :param columns: Optional feature indices to read
+        :return: in memory array of the trajectory's features(or the wanted
+        columns of them)
+        """
+        if columns is None:
+            return np.array(self[name])
+        return np.asarray(self[name][:, columns])
+
+
+def _data_file(folder, generation):
+    """
+    :return: the data file of a store generation in folder
+    """
+    return os.path.join(folder, _data_name%("" if generation is None else
+                                            "." + generation))
+
+
+def write_feature_store(folder, features):
+    """
+    Writes a feature store from (name, array) pairs, one array in memory at
+    a time. The data goes to a new generation's file and the index is
+    renamed over the old one last, so readers never pair an index with the
+    wrong data. Older generations are removed afterwards(open memory maps of
+    them stay valid).
+    :param folder: The folder to write the store to
+    :param features: iterable of (name, (n_frames, n_features) array)
+    :return: the FeatureStore
+    """
+    generation = uuid.uuid4().hex
+    data_file = _data_file(folder, generation)
+    index_file = os.path.join(folder, _index_name)
+
+    names = []
+    offsets = [0]
+    n_features = None
+    dtype = None
+    with open(data_file + ".tmp", "wb") as fout:
+        for name, array in features:
+            array = np.asarray(array)
+            if n_features is None:
+                n_features = array.shape[1]
+                dtype = array.dtype
+            elif array.shape[1] != n_features:
+                raise ValueError("%s has %d features instead of %d"
+                                 %(name, array.shape[1], n_features))
+            fout.write(np.ascontiguousarray(array, dtype=dtype).tobytes())
+            names.append(name)
+            offsets.append(offsets[-1] + array.shape[0])
+    os.rename(data_file + ".tmp", data_file)
+
+    index = {"names": names, "offsets": np.array(offsets, dtype=np.int64),
+             "n_features": n_features or 0,
+             "dtype": str(dtype or np.float32),
+             "generation": generation}
+    verbosedump(index, index_file + ".tmp")
+    os.rename(index_file + ".tmp", index_file)
+    for old_file in glob.glob(os.path.join(folder, _data_name%"*")):
+        if old_file != data_file:
+            os.remove(old_file)
+    return open_feature_store(folder, check_current=False)
+
+
+def build_feature_store(feature_folder):
+    """
+    Consolidates the .jl files of a feature folder into a feature store.
+    :param feature_folder: The feature folder
+    :return: the FeatureStore
+    """
+    flist = sorted(glob.glob(os.path.join(feature_folder, "*.jl")), key=keynat)
+    write_feature_store(feature_folder,
+                        ((os.path.basename(f), verboseload(f))
+                         for f in flist))
+    return open_feature_store(feature_folder)
+
+
+def build_series_feature_store(yaml_file, protein_list=None,
+                               folder_name=None):
+    """
+    :param yaml_file: The yaml file to work with
+    :param protein_list: list of proteins, if None then all
+    the proteins in yaml_file["protein_list"] are processed
+    :param folder_name: feature folder to consolidate, defaults to
+    yaml_file["feature_dir"]
+    :return:
+    """
+    yaml_file = load_yaml_file(yaml_file)
+    if protein_list is None:
+        protein_list = yaml_file["protein_list"]
+    if folder_name is None:
+        folder_name = yaml_file["feature_dir"]
+    for protein in protein_list:
+        print("Building feature store for %s"%protein)
+        build_feature_store(os.path.join(yaml_file["base_dir"], protein,
+                                         folder_name))
+    return
+
+
+def open_feature_store(feature_folder, check_current=True):
+    """
+    :param feature_folder: The feature folder
+    :param check_current: Check that no .jl file was written after the
+    store. Callers that already checked(e.g. a parent process handing out
+    jobs) can skip the per file stat calls.
+    :return: the folder's FeatureStore or None if it has none or it is out
+    of date
+    """
+    feature_folder = os.path.abspath(feature_folder)
+    index_file = os.path.join(feature_folder, _index_name)
+    if not os.path.isfile(index_file):
+        return None
+    index_mtime = os.stat(index_file).st_mtime
+    key = (feature_folder, index_mtime)
+    if key not in _store_cache:
+        try:
+            store = FeatureStore(feature_folder)
+        except (IOError, OSError):
+            #the data file of the index we read was replaced since, the
+            #new index is in place by then
+            index_mtime = os.stat(index_file).st_mtime
+            key = (feature_folder, index_mtime)
+            store = FeatureStore(feature_folder)
+        #drop the stores of older indexes, and with them their memory maps
+        for old_key in [k for k in _store_cache if k[0] == feature_folder]:
+            del _store_cache[old_key]
+        _store_cache[key] = store
+    store = _store_cache[key]
+    if check_current:
+        flist = glob.glob(os.path.join(feature_folder, "*.jl"))
+        if len(flist) != len(store) or \
+                any([os.stat(f).st_mtime > index_mtime for f in flist]):
+            return None
+    return store
+
+
+def load_tica_data(protein_mdl_dir):
+    """
+    :param protein_mdl_dir: The protein's model directory
+    :return: the protein's tica data keyed on trajectory name. That is the
+    memory mapped store written by transform_protein_tica, or the older
+    tica_data.pkl if there is no store or the pickle is newer.
+    """
+    store_folder = os.path.join(protein_mdl_dir, _tica_data_dir)
+    pkl_file = os.path.join(protein_mdl_dir, "tica_data.pkl")
+    store = open_feature_store(store_folder, check_current=False)
+    if store is None or (os.path.isfile(pkl_file) and
+                         os.stat(pkl_file).st_mtime >
+                         os.stat(os.path.join(store_folder,
+                                              _index_name)).st_mtime):
+        return verboseload(pkl_file)
+    return store
+
+
+def load_features(filename, columns=None, from_store=False):
+    """
+    Drop in replacement for verboseload on a .jl feature file.
+    :param filename: The .jl file
+    :param columns: Optional feature indices to read
+    :param from_store: Read from the folder's feature store, which the
+    caller has checked to be current
+    :return: array of features
+    """
+    if from_store:
+        store = open_feature_store(os.path.dirname(filename),
+                                   check_current=False)
+        return store.read(os.path.basename(filename), columns)
+    features = verboseload(filename)
+    if columns is None:
+        return features
+    return features[:, columns]
+
+
+def prefetch_features(load, items, n_prefetch=2, max_bytes=_prefetch_bytes,
+                      size=None):
+    """
+    Yields (item, load(item)) for every item in order while the next items
+    are loaded by a thread pool. At most n_prefetch items are loaded ahead
+    of the consumer, and no further ones are started while those add up to
+    more than max_bytes(one is always started). Exceptions raised by load
+    are raised to the consumer.
+    :param load: function loading an item
+    :param items: list of items
+    :param n_prefetch: number of items to load ahead of the consumer, 0
+    loads them serially
+    :param max_bytes: memory budget of the items loaded ahead, None for no
+    budget
+    :param size: function giving the estimated bytes of an item's load
+    """
+    if n_prefetch <= 0:
+        for item in items:
+            yield item, load(item)
+        return
+
+    items = list(items)
+    sizes = [size(item) if size is not None else 0 for item in items]
+    executor = ThreadPoolExecutor(max_workers=n_prefetch)
+    window = collections.deque()
+    state = {"position": 0, "ahead": 0}
+
+    def _fill():
+        position = state["position"]
+        while position < len(items) and len(window) < n_prefetch and \
+                (len(window) == 0 or max_bytes is None or
+                 state["ahead"] + sizes[position] <= max_bytes):
+            window.append((items[position], sizes[position],
+                           executor.submit(load, items[position])))
+            state["ahead"] += sizes[position]
+            position += 1
+        state["position"] = position
+
+    try:
+        _fill()
+        while window:
+            item, item_size, future = window.popleft()
+            state["ahead"] -= item_size
+            #the next items load while this one is waited on and consumed
+            _fill()
+            yield item, future.result()
+    finally:
+        for _, _, future in window:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def iter_protein_features(yaml_file, protein, folder_name=None, file_stride=1,
+                          nrm=None, prefetch=2, max_bytes=_prefetch_bytes):
+    """
+    :param yaml_file: The yaml file to work with
+    :param protein: Protein name
+    :param folder_name: feature folder, defaults to yaml_file["feature_dir"]
+    :param file_stride: Only yield every file_stride-th trajectory
+    :param nrm: Optional fit normalizer applied to the features on the fly
+    (see normalize_project_series with lazy=True)
+    :param prefetch: Number of trajectories loaded ahead of the consumer by
+    background threads(see prefetch_features), 0 loads them serially
+    :param max_bytes: Memory budget of the trajectories loaded ahead
+    :return: generator of (name, features) for the trajectories of the
+    protein, in natural order of the names. Features come from the feature
+    store when it is current and from the .jl files otherwise. Without
+    prefetch, store features are memory mapped views.
+    """
+    yaml_file = load_yaml_file(yaml_file)
+    if folder_name is None:
+        folder_name = yaml_file["feature_dir"]
+    feature_folder = os.path.join(yaml_file["base_dir"], protein, folder_name)
+    store = open_feature_store(feature_folder)
+    if store is not None:
+        names = sorted(store.names, key=keynat)[::file_stride]
+        row_bytes = store.n_features * store.dtype.itemsize
+
+        def _load(name):
+            features = store.read(name) if prefetch > 0 else store[name]
+            return features if nrm is None else nrm.transform(features)
+
+        def _size(name):
+            return store.n_frames(name) * row_bytes
+    else:
+        names = [os.path.basename(f) for f in
+                 sorted(glob.glob(os.path.join(feature_folder, "*.jl")),
+                        key=keynat)[::file_stride]]
+
+        def _load(name):
+            features = verboseload(os.path.join(feature_folder, name))
+            return features if nrm is None else nrm.transform(features)
+
+        def _size(name):
+            return os.path.getsize(os.path.join(feature_folder, name))
+    return prefetch_features(_load, names, prefetch, max_bytes, _size)
@@ -3,49 +3,400 @@
 import os
 import glob
 import mdtraj as mdt
-from kinase_msm.data_loader import load_yaml_file
+from kinase_msm.data_loader import load_yaml_file, iterload_hdf5, \
+    hdf5_n_frames, load_hdf5
 from msmbuilder.dataset import _keynat as keynat
-from msmbuilder.utils import verbosedump
+from msmbuilder.utils import verbosedump, verboseload
 import pandas as pd
+import numpy as np
 import itertools
 import warnings
-from msmbuilder.featurizer import DihedralFeaturizer
-
-def featurize_file(job_tuple):
-
-    yaml_file, protein, feat, traj_file,stride = job_tuple
-    yaml_file = load_yaml_file(yaml_file)
+import json
+import hashlib
+import tables
+from msmbuilder.featurizer import DihedralFeaturizer, ContactFeaturizer
+from sklearn.base import clone
+from mdtraj.utils import six
 
+def _featurizer_dict(yaml_file, feat):
+    """
+    :param yaml_file: The yaml file to work with
+    :param feat: None, a featurizer or a dictionary of featurizers keyed on
+    the name of their feature folder
+    :return: dictionary of featurizers keyed on their feature folder
+    """
+    if isinstance(feat, dict):
+        return feat
     if feat is None:
         feat = DihedralFeaturizer(types=['phi', 'psi','chi1'])
+    return {yaml_file["feature_dir"]: feat}
 
-    _check_output_folder_exists(yaml_file, protein)
 
-    output_folder = os.path.join(yaml_file["base_dir"],
-                                 protein,
-                                 yaml_file["feature_dir"])
+def _fingerprint(feat):
+    """
+    :param feat: Featurization obj
+    :return: hash of the featurizer's class and parameters
+    """
+    params = feat.get_params() if hasattr(feat, "get_params") else {}
+    description = hashlib.md5()
+    description.update(("%s.%s"%(type(feat).__module__,
+                                 type(feat).__name__)).encode())
+    for key, value in sorted(params.items()):
+        #the repr of large arrays is abbreviated, so hash their bytes
+        if isinstance(value, np.ndarray):
+            value = (value.shape, str(value.dtype),
+                     hashlib.md5(np.ascontiguousarray(value).tobytes()).hexdigest())
+        description.update(("%s=%r;"%(key, value)).encode())
+    return description.hexdigest()
 
-    traj_name = os.path.splitext(os.path.basename(traj_file))[0]
-    output_fname = os.path.join(output_folder, traj_name+".jl")
 
-    feat_descriptor = os.path.join(output_folder, "feature_descriptor.h5")
-    try:
-        trj = mdt.load(traj_file)
-    except :
+def _state_fname(output_folder, traj_name):
+    return os.path.join(output_folder, ".featurize_state", traj_name+".json")
+
+
+def _load_state(output_folder, traj_name):
+    """
+    :return: the sidecar state of a featurized trajectory or None if there
+    is no state or no output for it
+    """
+    state_fname = _state_fname(output_folder, traj_name)
+    if not (os.path.isfile(state_fname) and
+            os.path.isfile(os.path.join(output_folder, traj_name+".jl"))):
+        return None
+    with open(state_fname) as f:
+        return json.load(f)
+
+
+def _save_state(output_folder, traj_name, state):
+    state_fname = _state_fname(output_folder, traj_name)
+    if not os.path.isdir(os.path.dirname(state_fname)):
+        os.makedirs(os.path.dirname(state_fname))
+    with open(state_fname, 'w') as f:
+        json.dump(state, f)
+    return
+
+
+def _first_pending_frame(state, traj_state):
+    """
+    :param state: sidecar state of the existing output(or None)
+    :param traj_state: state describing the trajectory and featurizer now
+    :return: None if the output is current, otherwise the first frame that
+    has to be featurized(0 for a full featurization)
+    """
+    if state is None or state["fingerprint"] != traj_state["fingerprint"] \
+            or state["stride"] != traj_state["stride"]:
+        return 0
+    if state["mtime"] == traj_state["mtime"]:
+        return None
+    if state["n_frames"] > traj_state["n_frames"]:
+        return 0
+    #the tail starts at the next strided frame after the featurized ones
+    stride = traj_state["stride"]
+    done = -(-state["n_frames"] // stride)
+    if done * stride >= traj_state["n_frames"]:
+        return None
+    return done * stride
+
+
+def _required_atoms(feat, frame):
+    """
+    :param feat: Featurization obj
+    :param frame: a full frame of the trajectory
+    :return: sorted indices of the atoms feat reads or None if unknown
+    """
+    if isinstance(feat, DihedralFeaturizer):
+        indices = [getattr(mdt, "compute_%s"%t)(frame)[0] for t in feat.types]
+        return np.unique(np.concatenate([np.ravel(i) for i in indices])
+                         .astype(int))
+    if isinstance(feat, ContactFeaturizer) and \
+            not isinstance(feat.contacts, six.string_types):
+        residues = np.unique(feat.contacts)
+        return np.array(sorted([a.index for r in residues
+                                for a in frame.topology.residue(int(r)).atoms]),
+                        dtype=int)
+    return None
+
+
+def _subset_featurizers(feats, frame):
+    """
+    Works out the union of atoms the featurizers need and remaps them to
+    work on trajectories holding only those atoms.
+    :param feats: dictionary of featurizers
+    :param frame: a full frame of the trajectory
+    :return: the atom indices to read(None for all) and the dictionary of
+    featurizers to apply to the subset trajectories
+    """
+    required = [_required_atoms(f, frame) for f in feats.values()]
+    if frame.n_frames == 0 or any([r is None for r in required]):
+        return None, feats
+    atom_indices = np.unique(np.concatenate(required))
+    if len(atom_indices) == 0 or len(atom_indices) == frame.n_atoms:
+        return None, feats
+
+    sub_frame = frame.atom_slice(atom_indices)
+    new_residue = dict((frame.topology.atom(a).residue.index,
+                        sub_frame.topology.atom(i).residue.index)
+                       for i, a in enumerate(atom_indices))
+    sub_feats = {}
+    for folder_name, f in feats.items():
+        if isinstance(f, ContactFeaturizer):
+            contacts = [[new_residue[int(r)] for r in pair]
+                        for pair in f.contacts]
+            f = clone(f).set_params(contacts=np.array(contacts))
+        #the subset featurizer has to reproduce the full one exactly
+        expected = feats[folder_name].partial_transform(frame)
+        calculated = f.partial_transform(sub_frame)
+        if expected.shape != calculated.shape or \
+                not np.allclose(expected, calculated):
+            warnings.warn("Could not featurize an atom subset for %s"
+                          %folder_name)
+            return None, feats
+        sub_feats[folder_name] = f
+    return atom_indices, sub_feats
+
+
+#errors raised when reading a truncated or otherwise broken trajectory
+_misformed_errors = (IOError, OSError, ValueError, KeyError,
+                     tables.exceptions.HDF5ExtError,
+                     tables.exceptions.NoSuchNodeError)
+
+
+def _misformed_trajectory(traj_file, remove):
+    if remove:
         warnings.warn("Removing %s because of misformed trajectory"%traj_file)
         os.remove(traj_file)
+    else:
+        warnings.warn("Skipping %s because of misformed trajectory"%traj_file)
+    return
+
+
+def featurize_file(job_tuple):
+    """
+    Featurizes a trajectory one chunk at a time. Every chunk is loaded
+    once and handed to all the featurizers.
+    :param job_tuple: (yaml_file, protein, feat, traj_file, stride) and
+    optionally a dictionary of featurization options. "chunk" is the number
+    of frames(after striding) loaded at a time, defaults to 1000.
+    "incremental" skips outputs whose trajectory is unchanged and only
+    featurizes the new frames of trajectories that grew(see
+    featurize_project_wrapper). "atom_subset" only reads the atoms the
+    featurizers need. "remove_misformed" deletes trajectories that can not
+    be read, defaults to True. feat can be a dictionary of featurizers
+    keyed on the name of the feature folder their output goes to.
+    """
+    yaml_file, protein, feat, traj_file, stride = job_tuple[:5]
+    feat_opts = job_tuple[5] if len(job_tuple) > 5 else {}
+    chunk = feat_opts.get("chunk", 1000)
+    incremental = feat_opts.get("incremental", False)
+    atom_subset = feat_opts.get("atom_subset", False)
+    remove_misformed = feat_opts.get("remove_misformed", True)
+    stride = stride or 1
+    yaml_file = load_yaml_file(yaml_file)
+
+    feats = _featurizer_dict(yaml_file, feat)
+
+    for folder_name in feats.keys():
+        _check_output_folder_exists(yaml_file, protein, folder_name)
+
+    traj_name = os.path.splitext(os.path.basename(traj_file))[0]
+    output_folders = dict((folder_name,
+                           os.path.join(yaml_file["base_dir"], protein,
+                                        folder_name))
+                          for folder_name in feats.keys())
+
+    #first frame every output needs, None if it is up to date
+    starts = dict((folder_name, 0) for folder_name in feats.keys())
+    traj_states = {}
+    if incremental:
+        try:
+            n_frames = hdf5_n_frames(traj_file)
+        except _misformed_errors:
+            _misformed_trajectory(traj_file, remove_misformed)
+            return
+        mtime = os.stat(traj_file).st_mtime
+        for folder_name, f in feats.items():
+            traj_states[folder_name] = {"n_frames": n_frames, "mtime": mtime,
+                                        "fingerprint": _fingerprint(f),
+                                        "stride": stride}
+            state = _load_state(output_folders[folder_name], traj_name)
+            starts[folder_name] = _first_pending_frame(
+                state, traj_states[folder_name])
+            if starts[folder_name] is None and state["mtime"] != mtime:
+                _save_state(output_folders[folder_name], traj_name,
+                            traj_states[folder_name])
+        feats = dict((folder_name, f) for folder_name, f in feats.items()
+                     if starts[folder_name] is not None)
+        if len(feats) == 0:
+            print("Already featurized %s"%traj_file)
+            return
+
+    start = min([starts[folder_name] for folder_name in feats.keys()])
+    atom_indices = None
+    sub_feats = feats
+    first_frame = None
+    if atom_subset:
+        try:
+            first_frame = load_hdf5(traj_file, frame_index=start)
+        except _misformed_errors:
+            _misformed_trajectory(traj_file, remove_misformed)
+            return
+        atom_indices, sub_feats = _subset_featurizers(feats, first_frame)
+        if first_frame.n_frames == 0:
+            first_frame = None
+
+    features = dict((folder_name, []) for folder_name in feats.keys())
+    position = start
+    chunks = iterload_hdf5(traj_file, chunk=chunk, stride=stride, start=start,
+                           atom_indices=atom_indices)
+    while True:
+        try:
+            trj = next(chunks)
+        except StopIteration:
+            break
+        except _misformed_errors:
+            _misformed_trajectory(traj_file, remove_misformed)
+            return
+        if first_frame is None:
+            first_frame = trj[0]
+        for folder_name, f in sub_feats.items():
+            #outputs with a later start skip the frames they already have
+            skip = max(0, (starts[folder_name] - position) // stride)
+            if skip < trj.n_frames:
+                features[folder_name].append(f.partial_transform(trj[skip:]))
+        position += trj.n_frames * stride
+
+    if first_frame is None:
+        warnings.warn("Skipping %s because it has no frames"%traj_file)
         return
 
-    features = feat.partial_transform(trj)
-    verbosedump(features, output_fname)
+    for folder_name, f in feats.items():
+        output_folder = output_folders[folder_name]
+        output_fname = os.path.join(output_folder, traj_name+".jl")
+        new_features = np.concatenate(features[folder_name])
+        if starts[folder_name] > 0:
+            new_features = np.concatenate([verboseload(output_fname),
+                                           new_features])
+        verbosedump(new_features, output_fname)
+        if incremental:
+            _save_state(output_folder, traj_name, traj_states[folder_name])
 
-    if not os.path.isfile(feat_descriptor) and hasattr(feat, "describe_features"):
-        dih_df = pd.DataFrame(feat.describe_features(trj[0]))
-        verbosedump(dih_df, feat_descriptor)
+        feat_descriptor = os.path.join(output_folder, "feature_descriptor.h5")
+        if not os.path.isfile(feat_descriptor) and hasattr(f, "describe_features"):
+            dih_df = pd.DataFrame(f.describe_features(first_frame))
+            verbosedump(dih_df, feat_descriptor)
 
     return
 
 
+class FeatureAppender(object):
+    """
+    Featurizes frames as they are appended to a trajectory file, so that
+    hdf5_concatenate can write features together with the stripped
+    trajectories. Keeps the .jl files and the incremental featurization
+    state of featurize_file in sync with the trajectory.
+    """
+    def __init__(self, yaml_file, protein, traj_file, feat=None, stride=1):
+        """
+        :param yaml_file: The yaml file to work with(base_dir and
+        feature_dir are needed)
+        :param protein: Protein name
+        :param traj_file: The trajectory file frames are appended to
+        :param feat: Featurization obj or dictionary of them keyed on their
+        feature folder(see featurize_project_wrapper)
+        :param stride: Only featurize every stride-th frame
+        """
+        self.yaml_file = load_yaml_file(yaml_file)
+        self.protein = protein
+        self.traj_file = traj_file
+        self.feats = dict(_featurizer_dict(self.yaml_file, feat))
+        self.stride = stride or 1
+        self.traj_name = os.path.splitext(os.path.basename(traj_file))[0]
+
+        self.n_frames = 0
+        if os.path.isfile(traj_file):
+            #catch up on frames that were converted without features. The
+            #conversion owns the trajectory, so it is never removed here
+            featurize_file((self.yaml_file, protein, self.feats, traj_file,
+                            self.stride, {"incremental": True,
+                                          "remove_misformed": False}))
+            try:
+                self.n_frames = hdf5_n_frames(traj_file)
+            except _misformed_errors:
+                warnings.warn("Can not read %s, not featurizing it during "
+                              "conversion"%traj_file)
+                self.feats = {}
+
+        self.output_folders = {}
+        self.append_to = {}
+        for folder_name, f in list(self.feats.items()):
+            _check_output_folder_exists(self.yaml_file, protein, folder_name)
+            output_folder = os.path.join(self.yaml_file["base_dir"], protein,
+                                         folder_name)
+            state = _load_state(output_folder, self.traj_name)
+            in_sync = state is not None and \
+                state["n_frames"] == self.n_frames and \
+                state["fingerprint"] == _fingerprint(f) and \
+                state["stride"] == self.stride
+            if not in_sync and self.n_frames > 0:
+                warnings.warn("Features in %s are out of sync with %s, "
+                              "not featurizing them during conversion"
+                              %(output_folder, traj_file))
+                del self.feats[folder_name]
+                continue
+            self.output_folders[folder_name] = output_folder
+            self.append_to[folder_name] = in_sync
+        self.features = dict((folder_name, []) for folder_name in self.feats)
+        self.first_frame = None
+
+    def append(self, trj):
+        """
+        :param trj: frames that were just appended to the trajectory file
+        :return:
+        """
+        #keep the stride phase of the whole trajectory
+        selected = trj[(-self.n_frames) % self.stride::self.stride]
+        self.n_frames += trj.n_frames
+        if selected.n_frames == 0:
+            return
+        if self.first_frame is None:
+            self.first_frame = selected[0]
+        for folder_name, f in self.feats.items():
+            self.features[folder_name].append(f.partial_transform(selected))
+        return
+
+    def close(self):
+        """
+        Writes the new features and the featurization state. Has to be
+        called after the trajectory file is closed.
+        :return:
+        """
+        mtime = os.stat(self.traj_file).st_mtime
+        for folder_name, f in self.feats.items():
+            output_folder = self.output_folders[folder_name]
+            output_fname = os.path.join(output_folder, self.traj_name+".jl")
+            if len(self.features[folder_name]) > 0:
+                new_features = np.concatenate(self.features[folder_name])
+                if self.append_to[folder_name]:
+                    new_features = np.concatenate([verboseload(output_fname),
+                                                   new_features])
+                verbosedump(new_features, output_fname)
+            elif not os.path.isfile(output_fname):
+                continue
+            _save_state(output_folder, self.traj_name,
+                        {"n_frames": self.n_frames, "mtime": mtime,
+                         "fingerprint": _fingerprint(f),
+                         "stride": self.stride})
+
+            feat_descriptor = os.path.join(output_folder,
+                                           "feature_descriptor.h5")
+            if self.first_frame is not None and \
+                    not os.path.isfile(feat_descriptor) and \
+                    hasattr(f, "describe_features"):
+                dih_df = pd.DataFrame(f.describe_features(self.first_frame))
+                verbosedump(dih_df, feat_descriptor)
+        return
+
+
 def _check_output_folder_exists(yaml_file, protein, folder_name=None):
     yaml_file = load_yaml_file(yaml_file)
     if folder_name is None:
@@ -58,21 +409,38 @@ def _check_output_folder_exists(yaml_file, protein, folder_name=None):
 
     return
 
-def featurize_project_wrapper(yaml_file, protein, feat=None, stride=1, view=None, protein_only=True):
+def featurize_project_wrapper(yaml_file, protein, feat=None, stride=1,
+                              view=None, protein_only=True, chunk=1000,
+                              incremental=False, atom_subset=False):
     """
     Wrapper function for featurizing project.
     :param yaml_file: The yaml file to work with
     :param protein: Protein Name
     :param feat: Featurization obj. If none, it defaults to
-    phi, psi and chi1. Should support a describe_features attribute
+    phi, psi and chi1. Should support a describe_features attribute.
+    Can also be a dictionary of featurization objs keyed on the name of
+    the feature folder(inside the protein folder) each one writes to. All of
+    them are computed from a single pass over every trajectory.
+    :param stride: Only featurize every stride-th frame
     :param view: ipython view or pool view to parallelize over.
+    :param chunk: Number of frames each worker loads and featurizes at a
+    time. Bounds the worker memory independent of the trajectory length.
+    :param incremental: Record the frame count, mtime, stride and featurizer
+    fingerprint of every trajectory in <feature folder>/.featurize_state.
+    Later calls skip unchanged trajectories and, for trajectories that only
+    gained frames, featurize the new tail and append it to the output.
+    :param atom_subset: Only read the atoms the featurizers use. Supported
+    for dihedral featurizers and contact featurizers with explicit residue
+    pairs, anything else reads all atoms. The subset featurizers are checked
+    against the full ones on the first frame of every trajectory.
     :return:
     """
 
     yaml_file = load_yaml_file(yaml_file)
     base_dir = yaml_file["base_dir"]
 
-    _check_output_folder_exists(yaml_file, protein)
+    for folder_name in _featurizer_dict(yaml_file, feat).keys():
+        _check_output_folder_exists(yaml_file, protein, folder_name)
     #get the paths
     if protein_only:
         traj_folder = os.path.join(base_dir, protein, yaml_file["protein_dir"])
@@ -83,7 +451,10 @@ def featurize_project_wrapper(yaml_file, protein, feat=None, stride=1, view=None
     print("Found %d files for featurization in %s"
           %(len(traj_files), traj_folder))
 
-    jobs = [(yaml_file, protein, feat, traj_file, stride) for traj_file in traj_files]
+    feat_opts = {"chunk": chunk, "incremental": incremental,
+                 "atom_subset": atom_subset}
+    jobs = [(yaml_file, protein, feat, traj_file, stride, feat_opts)
+            for traj_file in traj_files]
 
     result = view.map(featurize_file, jobs)
 
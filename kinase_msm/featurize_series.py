@@ -2,12 +2,15 @@
 from kinase_msm.featurize_project import featurize_project_wrapper
 from kinase_msm.data_loader import load_yaml_file
 
-def featurize_series(yaml_file, ip_view, protein_list = None):
+def featurize_series(yaml_file, ip_view, protein_list = None, feat=None):
     """
     :param yaml_file: The yaml file to work with
     :param ip_view: ipython view(required)
     :param protein_list: list of proteins, if None then all
     the proteins in yaml_file["protein_list"] are processed
+    :param feat: Featurization obj or dictionary of them keyed on their
+    feature folder(see featurize_project_wrapper). Defaults to phi, psi
+    and chi1
     :return: converted and concatenated trajectories in
     yaml_file["base_dir"]+protein_name+trajectories
     and the stripped files in
@@ -20,5 +23,5 @@ def featurize_series(yaml_file, ip_view, protein_list = None):
         protein_list = yaml_file["protein_list"]
 
     for protein in protein_list:
-        featurize_project_wrapper(yaml_file, protein, None, 1, ip_view)
+        featurize_project_wrapper(yaml_file, protein, feat, 1, ip_view)
     return
\ No newline at end of file
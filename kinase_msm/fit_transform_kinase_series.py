@@ -7,11 +7,17 @@ import glob
 from msmbuilder.msm import BayesianMarkovStateModel, MarkovStateModel
 from msmbuilder.msm.validation import BootStrapMarkovStateModel
 import os
+import numpy as np
 from msmbuilder.cluster import MiniBatchKMeans, KMeans
 from msmbuilder.dataset import _keynat as keynat
-from .data_loader import enter_protein_data_dir, enter_protein_mdl_dir, load_yaml_file
-
-def fit_protein_tica(yaml_file,sparse=False,ksparse=None):
+from .data_loader import enter_protein_mdl_dir, load_yaml_file
+from .feature_store import iter_protein_features, prefetch_features, \
+    load_features, write_feature_store, load_tica_data, _tica_data_dir
+from .tica_covariance import accumulate_series, inject_accumulators, \
+    _protein_feature_files
+
+def fit_protein_tica(yaml_file,sparse=False,ksparse=None,nrm=None,view=None,
+                     cache=False,protein_list=None,traj_filter=None):
     mdl_dir = yaml_file["mdl_dir"]
     mdl_params = yaml_file["mdl_params"]
 
@@ -28,13 +34,27 @@ def fit_protein_tica(yaml_file,sparse=False,ksparse=None):
     else:
         protein_tica_mdl = tICA(**current_mdl_params)
 
-    for protein in yaml_file["protein_list"]:
-        print("Fitting to protein %s" % protein)
-        with enter_protein_data_dir(yaml_file, protein):
-            featurized_traj = sorted(glob.glob("./%s/*.jl" %
-                                               yaml_file["feature_dir"]), key=keynat)
-            for f in featurized_traj:
-                featurized_path = verboseload(f)
+    if protein_list is None:
+        protein_list = yaml_file["protein_list"]
+
+    if view is not None or cache or traj_filter is not None:
+        #map-reduce over the covariance accumulators(see tica_covariance)
+        accumulators = accumulate_series(yaml_file,
+                                         protein_tica_mdl.lag_time,
+                                         view, protein_list=protein_list,
+                                         nrm=nrm, cache=cache,
+                                         traj_filter=traj_filter)
+        if accumulators is None:
+            raise ValueError("No readable trajectories longer than the lag "
+                             "time to fit the tica model to")
+        inject_accumulators(protein_tica_mdl, accumulators)
+        print("Done fitting to %d trajectories" %
+              protein_tica_mdl.n_sequences_)
+    else:
+        for protein in protein_list:
+            print("Fitting to protein %s" % protein)
+            for f, featurized_path in iter_protein_features(yaml_file, protein,
+                                                             nrm=nrm):
                 try:
                     protein_tica_mdl.partial_fit(featurized_path)
                 except:
@@ -46,26 +66,105 @@ def fit_protein_tica(yaml_file,sparse=False,ksparse=None):
     return
 
 
-def transform_protein_tica(yaml_file):
+def _transform_files(job_tuple):
+    """
+    :param job_tuple: (tica_mdl, feature_folder, names, from_store, nrm,
+    part_file) where names are the .jl files to transform and part_file is
+    the .npy file their concatenated tica data is saved to
+    :return: list of (name, n_frames) of the transformed trajectories
+    """
+    tica_mdl, feature_folder, names, from_store, nrm, part_file = job_tuple
+
+    def _load(name):
+        features = load_features(os.path.join(feature_folder, name),
+                                  from_store=from_store)
+        return features if nrm is None else nrm.transform(features)
+
+    lengths = []
+    tica_data = []
+    for name, features in prefetch_features(
+            _load, names,
+            size=lambda name: os.path.getsize(os.path.join(feature_folder,
+                                                           name))):
+        try:
+            tica_data.append(tica_mdl.partial_transform(features))
+        except:
+            continue
+        lengths.append((name, len(tica_data[-1])))
+    if len(tica_data) > 0:
+        np.save(part_file, np.concatenate(tica_data))
+    return lengths
+
+
+def _assemble_tica_data(store_folder, parts):
+    """
+    Writes the tica data store of a protein from the part files of its
+    transform jobs and removes them.
+    :param store_folder: The protein's tica data folder
+    :param parts: list of (part_file, lengths) in trajectory order
+    """
+    def _tica_data():
+        for part_file, lengths in parts:
+            if len(lengths) == 0:
+                continue
+            part = np.load(part_file, mmap_mode='r')
+            offset = 0
+            for name, n_frames in lengths:
+                yield name, part[offset:offset + n_frames]
+                offset += n_frames
+            del part
+    write_feature_store(store_folder, _tica_data())
+    for part_file, _ in parts:
+        if os.path.isfile(part_file):
+            os.remove(part_file)
+    return
+
+
+def transform_protein_tica(yaml_file,nrm=None,view=None,chunk=20):
+    """
+    Transforms the features of every protein with the fit tica model. The
+    output of each protein is a memory mapped store of the trajectories'
+    tica data in mdl_dir/<protein>/tica_data(see load_tica_data).
+    :param yaml_file: The yaml file to work with
+    :param nrm: Optional fit normalizer applied to the features
+    :param view: ipython view or pool view to parallelize over the files of
+    all the proteins. Defaults to None which transforms serially.
+    :param chunk: Number of files per job
+    :return:
+    """
     mdl_dir = yaml_file["mdl_dir"]
     tica_obj_path = os.path.join(mdl_dir, "tica_mdl.pkl")
     protein_tica_mdl = verboseload(tica_obj_path)
+    #solve once here instead of in every job
+    _ = protein_tica_mdl.components_
+
+    jobs = []
+    protein_parts = {}
     for protein in yaml_file["protein_list"]:
-        with enter_protein_data_dir(yaml_file, protein):
-            print("Transforming protein %s" % protein)
-            featurized_traj = sorted(glob.glob("./%s/*.jl" %
-                                               yaml_file["feature_dir"]), key=keynat)
-            tica_data = {}
-            for f in featurized_traj:
-                featurized_path = verboseload(f)
-                try:
-                    tica_data[os.path.basename(f)] = \
-                        protein_tica_mdl.partial_transform(featurized_path)
-                except:
-                    pass
-            with enter_protein_mdl_dir(yaml_file, protein):
-                verbosedump(tica_data, 'tica_data.pkl')
-                print("Done transforming protein %s" % protein)
+        feature_folder, names, from_store = \
+            _protein_feature_files(yaml_file, protein)
+        store_folder = os.path.join(mdl_dir, protein, _tica_data_dir)
+        if not os.path.isdir(store_folder):
+            os.makedirs(store_folder)
+        protein_parts[protein] = []
+        for i in range(0, len(names), chunk):
+            part_file = os.path.join(store_folder, "_part%d.npy"%(i // chunk))
+            protein_parts[protein].append(part_file)
+            jobs.append((protein_tica_mdl, feature_folder, names[i:i + chunk],
+                         from_store, nrm, part_file))
+
+    print("Transforming %d jobs" % len(jobs))
+    if view is None:
+        results = list(map(_transform_files, jobs))
+    else:
+        results = list(view.map(_transform_files, jobs))
+    lengths = dict((job[-1], result) for job, result in zip(jobs, results))
+
+    for protein in yaml_file["protein_list"]:
+        _assemble_tica_data(os.path.join(mdl_dir, protein, _tica_data_dir),
+                            [(part_file, lengths[part_file])
+                             for part_file in protein_parts[protein]])
+        print("Done transforming protein %s" % protein)
 
     # dumping the tica_mdl again since the eigenspectrum might have been calculated
     tica_mdl_path = os.path.join(mdl_dir, "tica_mdl.pkl")
@@ -91,7 +190,7 @@ def fit_protein_kmeans(yaml_file,mini=True):
 
     for protein in yaml_file["protein_list"]:
         with enter_protein_mdl_dir(yaml_file, protein):
-            tica_data = verboseload("tica_data.pkl")
+            tica_data = load_tica_data(".")
             # get all traj
             sorted_list = sorted(tica_data.keys(), key=keynat)
             data.extend([tica_data[i] for i in sorted_list])
@@ -109,7 +208,7 @@ def transform_protein_kmeans(yaml_file):
     for protein in yaml_file["protein_list"]:
         print("Assigning protein %s" % protein)
         with enter_protein_mdl_dir(yaml_file, protein):
-            tica_data = verboseload("tica_data.pkl")
+            tica_data = load_tica_data(".")
             # do assignments
             assignments = {}
             for i in tica_data.keys():
@@ -3,6 +3,7 @@
 import os
 from msmbuilder.utils import verboseload, verbosedump
 from .data_loader import load_yaml_file
+from .feature_store import load_tica_data
 import numpy as np
 
 class ProteinSeries(object):
@@ -41,7 +42,7 @@ class Protein(object):
             self.msm =verboseload("%s/msm_mdl.pkl" % self.protein_mdl_dir)
         if os.path.isfile("%s/bayesmsm_mdl.pkl" % self.protein_mdl_dir):
             self.bayesmsm = verboseload("%s/bayesmsm_mdl.pkl" % self.protein_mdl_dir)
-        self.tica_data = verboseload("%s/tica_data.pkl" % self.protein_mdl_dir)
+        self.tica_data = load_tica_data(self.protein_mdl_dir)
         self.assignments = verboseload(
             "%s/assignments.pkl" % self.protein_mdl_dir)
         self.fixed_assignments = verboseload(
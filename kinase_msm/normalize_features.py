@@ -4,59 +4,116 @@ import glob
 import mdtraj as mdt
 from kinase_msm.data_loader import load_yaml_file
 from msmbuilder.dataset import _keynat as keynat
-from msmbuilder.utils import verbosedump, verboseload
+from msmbuilder.utils import verbosedump
 import pandas as pd
 from sklearn import preprocessing
 from .featurize_project import _check_output_folder_exists
 from .data_loader import enter_protein_mdl_dir, enter_protein_data_dir
+from .feature_store import iter_protein_features, open_feature_store, \
+    load_features, prefetch_features
 
 #normalize
 
 
+def fit_normalizer(yaml_file, nrm=None, stride=1):
+    """
+    Fits a normalizer by streaming over the features of all the proteins,
+    one trajectory at a time, with its partial_fit. The running mean and
+    variance updates of the standard scaler make the result the same as a
+    single fit on all the frames, while only one trajectory is in memory at
+    a time.
+    :param yaml_file: The yaml file to work with.
+    :param nrm: unfit normalizer supporting partial_fit. defaults to the
+    standard scaler from scikitlearn
+    :param stride: Only use every stride-th file. defaults to all files
+    :return: the fit normalizer
+    """
+    yaml_file = load_yaml_file(yaml_file)
+    if nrm is None:
+        nrm = preprocessing.StandardScaler()
+    for prt in yaml_file["protein_list"]:
+        print(prt)
+        for f, features in iter_protein_features(yaml_file, prt,
+                                                 file_stride=stride):
+            if len(features) > 0:
+                nrm.partial_fit(features)
+    return nrm
+
+
+def _normalize_files(job_tuple):
+    """
+    :param job_tuple: (nrm, list of (input file, output file), from_store)
+    :return:
+    """
+    nrm, file_pairs, from_store = job_tuple
+
+    def _load(file_pair):
+        return nrm.transform(load_features(file_pair[0], from_store=from_store))
+
+    #the next files load and transform while the current one is written
+    for (input_file, output_file), res in prefetch_features(
+            _load, file_pairs, size=lambda p: os.path.getsize(p[0])):
+        verbosedump(res, output_file)
+    return
+
+
 def normalize_project_series(yaml_file, output_folder="normalized_features",
-                             stride=40,nrm=None):
+                             stride=1,nrm=None, view=None, lazy=False,
+                             chunk=50):
     """
     routine to take a set of proteins features stored in the feature_dir and
     normalize them by removing the mean and setting variance to 1 using the standard
     scaler. The normalizer is dumped into the mdl dir.
     :param yaml_file: The yaml file to work with.
     :param output_folder: The name of the output folder to dump normalized features in
-    :param stride: The initial stride in files to fit the normalizer with.
-    This is necessary to prevent memory errors. defaults to every 40th file
+    :param stride: The stride in files to fit the normalizer with. The fit
+    streams over the files(see fit_normalizer), so memory does not grow with
+    the number of files. defaults to every file, pass e.g. 40 to only fit
+    to every 40th file as this routine used to
     :param nrm: previously fit normalizer. else it uses the standard scaler from
     scikitlearn
-    :return:
+    :param view: ipython view or pool view to parallelize the transform
+    over. Defaults to None which transforms serially.
+    :param lazy: Only fit and dump the normalizer, without writing the
+    normalized features. Pass the normalizer as nrm to the feature readers
+    (e.g. fit_protein_tica/transform_protein_tica) to normalize on the fly.
+    :param chunk: Number of files per transform job
+    :return: the normalizer
     """
     yaml_file = load_yaml_file(yaml_file)
     #setup normalizer
     if nrm is None:
-        nrm = preprocessing.StandardScaler()
-        all_data = {}
-        for prt in yaml_file["protein_list"]:
-            with enter_protein_data_dir(yaml_file, prt):
-                print(prt)
-                flist = glob.glob("./%s/*.jl"%(yaml_file["feature_dir"]))[::stride]
-                for f in flist:
-                     all_data[f]=verboseload(f)
-
-        seq=[]
-        for i in all_data.keys():
-           seq.extend(all_data[i])
-
-        #fit it
-        nrm.fit(seq)
+        nrm = fit_normalizer(yaml_file, stride=stride)
         #dump it into the mdl dir.
         verbosedump(nrm,"%s/nrm.h5"%yaml_file["mdl_dir"])
 
+    if lazy:
+        return nrm
+
+    jobs = []
     for prt in yaml_file["protein_list"]:
         _check_output_folder_exists(yaml_file, prt, output_folder)
 
         with enter_protein_data_dir(yaml_file, prt):
             output_folder_path = os.path.abspath(output_folder)
-            flist = glob.glob("./%s/*.jl"%(yaml_file["feature_dir"]))
-            for f in flist:
-                res = verboseload(f)
-                res = nrm.transform(res)
-                verbosedump(res,"%s/%s"%(output_folder_path, os.path.basename(f)))
+            feature_folder = os.path.abspath(yaml_file["feature_dir"])
+        #workers read the store without rechecking it
+        store = open_feature_store(feature_folder)
+        if store is not None:
+            names = store.names
+        else:
+            names = [os.path.basename(f) for f in
+                     glob.glob(os.path.join(feature_folder, "*.jl"))]
+        file_pairs = [(os.path.join(feature_folder, f),
+                       os.path.join(output_folder_path, f))
+                      for f in sorted(names, key=keynat)]
+        jobs.extend([(nrm, file_pairs[i:i + chunk], store is not None)
+                     for i in range(0, len(file_pairs), chunk)])
 
-    return
+    if view is None:
+        list(map(_normalize_files, jobs))
+    else:
+        #consume the results so asynchronous views are waited on
+        list(view.map(_normalize_files, jobs))
+
+    return nrm
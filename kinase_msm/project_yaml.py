@@ -0,0 +1,13 @@
+#!/bin/env python
+import yaml
+"""
+Reading the project yaml file. Kept apart from data_loader so that the
+modules data_loader imports(e.g. feature_store) can read it too.
+"""
+
+
+def load_yaml_file(yaml_file):
+    if isinstance(yaml_file, dict):
+        return yaml_file
+    else:
+        return yaml.load(open(yaml_file, 'r'))
@@ -1,14 +1,14 @@
-from kinase_msm.data_loader import load_yaml_file, enter_protein_data_dir
+from kinase_msm.data_loader import load_yaml_file, enter_protein_data_dir, \
+    load_hdf5
 from kinase_msm.featurize_project import _check_output_folder_exists
 import yaml
 import os,glob
-import mdtraj as md
 import itertools
 from multiprocessing import Pool, cpu_count
 
 def subsample_traj(jt):
     inp_file,output_file,stride = jt
-    t = md.load(inp_file, stride=stride)
+    t = load_hdf5(inp_file, stride=stride)
     t.save_hdf5(output_file)
     return
 
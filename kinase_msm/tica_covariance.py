@@ -0,0 +1,401 @@
+#!/bin/env python
+from __future__ import print_function
+import os
+import glob
+import numpy as np
+import pandas as pd
+from sklearn.base import clone
+from msmbuilder.dataset import _keynat as keynat
+from .data_loader import load_yaml_file
+from .feature_store import open_feature_store, load_features, \
+    prefetch_features
+"""
+Map-reduce tICA fitting. Workers compute the time lagged covariance and
+mean accumulators of msmbuilder's tICA for batches of trajectories, the
+accumulators are summed and injected into a tICA model, which is then the
+same as one partial fit to every trajectory in turn.
+
+The accumulators of every trajectory can be cached next to its features
+(<feature folder>/tica_cov_lag<lag time>/<trajectory>.npz), so that models
+for any subset of proteins or trajectories are assembled without reading
+the features again. Several lag times can be accumulated from a single
+read of the features(see scan_lag_times).
+"""
+
+#the running sums tICA.partial_fit updates
+_accumulator_names = ["_outer_0_to_T_lagged", "_sum_0_to_TminusTau",
+                      "_sum_tau_to_T", "_sum_0_to_T",
+                      "_outer_0_to_TminusTau", "_outer_offset_to_T"]
+
+
+def trajectory_accumulators(X, lag_time):
+    """
+    :param X: (n_frames, n_features) array of features
+    :param lag_time: tICA lag time in frames
+    :return: dictionary of the tICA accumulators of the trajectory, along
+    with n_observations_ and n_sequences_, or None if the trajectory is not
+    longer than the lag time(tICA.partial_fit skips those)
+    """
+    X = np.asarray(X, dtype=np.float64)
+    if X.ndim != 2 or not len(X) > lag_time:
+        return None
+    head = X[:-lag_time]
+    tail = X[lag_time:]
+    return {"_outer_0_to_T_lagged": np.dot(head.T, tail),
+            "_sum_0_to_TminusTau": head.sum(axis=0),
+            "_sum_tau_to_T": tail.sum(axis=0),
+            "_sum_0_to_T": X.sum(axis=0),
+            "_outer_0_to_TminusTau": np.dot(head.T, head),
+            "_outer_offset_to_T": np.dot(tail.T, tail),
+            "n_observations_": X.shape[0],
+            "n_sequences_": 1}
+
+
+def _add_accumulators(merged, acc):
+    """
+    :return: merged plus acc, updating merged in place
+    """
+    if acc is None:
+        return merged
+    if merged is None:
+        return dict((k, np.array(v, copy=True)) for k, v in acc.items())
+    if merged["_sum_0_to_T"].shape != acc["_sum_0_to_T"].shape:
+        raise ValueError("Can not merge accumulators of %d and %d features"
+                         %(len(merged["_sum_0_to_T"]),
+                           len(acc["_sum_0_to_T"])))
+    for k in merged.keys():
+        merged[k] += acc[k]
+    return merged
+
+
+def merge_accumulators(accumulators):
+    """
+    :param accumulators: iterable of accumulator dictionaries(or None)
+    :return: their sum, or None if there were none
+    """
+    merged = None
+    for acc in accumulators:
+        merged = _add_accumulators(merged, acc)
+    return merged
+
+
+def inject_accumulators(tica_mdl, accumulators):
+    """
+    Adds merged accumulators to a tICA model as if it had been partially
+    fit to the trajectories they came from.
+    :param tica_mdl: tICA(or SparseTICA/KSparseTICA) model
+    :param accumulators: merged accumulator dictionary
+    :return: the model
+    """
+    if accumulators is None:
+        return tica_mdl
+    tica_mdl._initialize(len(accumulators["_sum_0_to_T"]))
+    for name in _accumulator_names:
+        setattr(tica_mdl, name, getattr(tica_mdl, name) + accumulators[name])
+    tica_mdl.n_observations_ += int(accumulators["n_observations_"])
+    tica_mdl.n_sequences_ += int(accumulators["n_sequences_"])
+    tica_mdl._is_dirty = True
+    return tica_mdl
+
+
+def normalize_accumulators(accumulators, nrm, lag_time):
+    """
+    Turns the accumulators of raw features into those of the normalized
+    features, so that cached raw accumulators serve any normalizer.
+    :param accumulators: merged accumulator dictionary of raw features
+    :param nrm: fit StandardScaler(anything with mean_ and scale_)
+    :param lag_time: tICA lag time in frames
+    :return: accumulators of nrm.transform of the features
+    """
+    if accumulators is None or nrm is None:
+        return accumulators
+    if not (hasattr(nrm, "mean_") and hasattr(nrm, "scale_")):
+        raise ValueError("Only normalizers with a mean_ and scale_ can be "
+                         "applied to accumulators")
+    n_features = len(accumulators["_sum_0_to_T"])
+    mean = np.zeros(n_features) if nrm.mean_ is None else nrm.mean_
+    scale = np.ones(n_features) if nrm.scale_ is None else nrm.scale_
+    n_lagged = accumulators["n_observations_"] - \
+        lag_time * accumulators["n_sequences_"]
+
+    def _sum(name, n):
+        return (accumulators[name] - n * mean) / scale
+
+    def _outer(name, first_sum, second_sum):
+        outer = accumulators[name] - np.outer(accumulators[first_sum], mean) \
+            - np.outer(mean, accumulators[second_sum]) \
+            + n_lagged * np.outer(mean, mean)
+        return outer / np.outer(scale, scale)
+
+    normalized = dict(accumulators)
+    normalized["_outer_0_to_T_lagged"] = _outer("_outer_0_to_T_lagged",
+                                                "_sum_0_to_TminusTau",
+                                                "_sum_tau_to_T")
+    normalized["_outer_0_to_TminusTau"] = _outer("_outer_0_to_TminusTau",
+                                                 "_sum_0_to_TminusTau",
+                                                 "_sum_0_to_TminusTau")
+    normalized["_outer_offset_to_T"] = _outer("_outer_offset_to_T",
+                                              "_sum_tau_to_T",
+                                              "_sum_tau_to_T")
+    normalized["_sum_0_to_TminusTau"] = _sum("_sum_0_to_TminusTau", n_lagged)
+    normalized["_sum_tau_to_T"] = _sum("_sum_tau_to_T", n_lagged)
+    normalized["_sum_0_to_T"] = _sum("_sum_0_to_T",
+                                     accumulators["n_observations_"])
+    return normalized
+
+
+def _cache_fname(feature_folder, name, lag_time):
+    return os.path.join(feature_folder, "tica_cov_lag%d"%lag_time,
+                        os.path.splitext(name)[0] + ".npz")
+
+
+def _cache_is_current(feature_folder, name, lag_time):
+    cache_fname = _cache_fname(feature_folder, name, lag_time)
+    return os.path.isfile(cache_fname) and \
+        os.stat(cache_fname).st_mtime >= \
+        os.stat(os.path.join(feature_folder, name)).st_mtime
+
+
+def cached_accumulators(feature_folder, name, lag_time, from_store=False,
+                        features=None):
+    """
+    :param feature_folder: The feature folder
+    :param name: The .jl file name
+    :param lag_time: tICA lag time in frames
+    :param from_store: Read the features from the folder's feature store
+    :param features: Optional already loaded raw features of the file
+    :return: the trajectory's accumulators of the raw features, from the
+    cache if it is newer than the .jl file. Otherwise they are computed and
+    cached.
+    """
+    cache_fname = _cache_fname(feature_folder, name, lag_time)
+    feature_fname = os.path.join(feature_folder, name)
+    if _cache_is_current(feature_folder, name, lag_time):
+        with np.load(cache_fname) as f:
+            #short trajectories are cached as empty files
+            return dict(f.items()) if len(f.files) > 0 else None
+
+    if features is None:
+        features = load_features(feature_fname, from_store=from_store)
+    accumulators = trajectory_accumulators(features, lag_time)
+    try:
+        os.makedirs(os.path.dirname(cache_fname))
+    except OSError:
+        pass
+    with open(cache_fname + ".tmp", "wb") as f:
+        np.savez(f, **(accumulators or {}))
+    os.rename(cache_fname + ".tmp", cache_fname)
+    return accumulators
+
+
+def accumulate_files_lags(job_tuple):
+    """
+    Accumulates several lag times from a single read of every file.
+    :param job_tuple: (feature_folder, names, from_store, lag_times, nrm,
+    cache) as for accumulate_files but with a list of lag times
+    :return: list of the merged accumulators for every lag time. Files that
+    can not be read or accumulated are reported and skipped.
+    """
+    feature_folder, names, from_store, lag_times, nrm, cache = job_tuple
+
+    def _load(name):
+        #with the cache, files are only read if a lag time is missing
+        if cache and all([_cache_is_current(feature_folder, name, lag)
+                          for lag in lag_times]):
+            return None
+        #unreadable files are reported and skipped by the consumer
+        try:
+            return load_features(os.path.join(feature_folder, name),
+                                 from_store=from_store)
+        except Exception as e:
+            return e
+
+    def _size(name):
+        return os.path.getsize(os.path.join(feature_folder, name))
+
+    merged = [None] * len(lag_times)
+    #the next files load while the current one is accumulated
+    for name, features in prefetch_features(_load, names, size=_size):
+        try:
+            if isinstance(features, Exception):
+                raise features
+            if cache:
+                accumulators = [cached_accumulators(feature_folder, name, lag,
+                                                    from_store, features)
+                                for lag in lag_times]
+            else:
+                if nrm is not None:
+                    features = nrm.transform(features)
+                accumulators = [trajectory_accumulators(features, lag)
+                                for lag in lag_times]
+            merged = [_add_accumulators(m, acc)
+                      for m, acc in zip(merged, accumulators)]
+        except Exception as e:
+            #like the serial partial fit, a bad file does not fail the job
+            print("Skipping %s because of %s"%(os.path.join(feature_folder,
+                                                             name), repr(e)))
+            continue
+    if cache:
+        #the caches hold raw features
+        merged = [normalize_accumulators(m, nrm, lag)
+                  for m, lag in zip(merged, lag_times)]
+    return merged
+
+
+def accumulate_files(job_tuple):
+    """
+    :param job_tuple: (feature_folder, names, from_store, lag_time, nrm)
+    and optionally a cache flag, where names are the .jl files to
+    accumulate, from_store says whether to read them from the folder's
+    feature store and nrm is an optional fit normalizer applied to the
+    features. With the cache flag the accumulators are read from and
+    written to the trajectories' caches.
+    :return: merged accumulators of the files
+    """
+    feature_folder, names, from_store, lag_time, nrm = job_tuple[:5]
+    cache = job_tuple[5] if len(job_tuple) > 5 else False
+    return accumulate_files_lags((feature_folder, names, from_store,
+                                  [lag_time], nrm, cache))[0]
+
+
+def _protein_feature_files(yaml_file, protein):
+    """
+    :return: feature folder of the protein, its .jl names in natural order
+    and whether they can be read from the feature store
+    """
+    feature_folder = os.path.join(yaml_file["base_dir"], protein,
+                                  yaml_file["feature_dir"])
+    store = open_feature_store(feature_folder)
+    if store is not None:
+        names = store.names
+    else:
+        names = [os.path.basename(f) for f in
+                 glob.glob(os.path.join(feature_folder, "*.jl"))]
+    return feature_folder, sorted(names, key=keynat), store is not None
+
+
+def _series_jobs(yaml_file, lag_times, protein_list, nrm, chunk, cache,
+                 traj_filter):
+    """
+    :return: list of accumulate_files_lags job tuples for the series
+    """
+    yaml_file = load_yaml_file(yaml_file)
+    if protein_list is None:
+        protein_list = yaml_file["protein_list"]
+    jobs = []
+    for protein in protein_list:
+        feature_folder, names, from_store = \
+            _protein_feature_files(yaml_file, protein)
+        if traj_filter is not None:
+            names = [name for name in names if traj_filter(protein, name)]
+        print("Found %d trajectories for %s"%(len(names), protein))
+        jobs.extend([(feature_folder, names[i:i + chunk], from_store,
+                      lag_times, nrm, cache)
+                     for i in range(0, len(names), chunk)])
+    return jobs
+
+
+def accumulate_series_lags(yaml_file, lag_times, view=None, protein_list=None,
+                           nrm=None, chunk=20, cache=False, traj_filter=None):
+    """
+    Accumulates several lag times in a single pass over the features. See
+    accumulate_series for the parameters.
+    :return: list of the merged accumulators of all the trajectories for
+    every lag time
+    """
+    jobs = _series_jobs(yaml_file, list(lag_times), protein_list, nrm, chunk,
+                        cache, traj_filter)
+    if view is None:
+        results = map(accumulate_files_lags, jobs)
+    else:
+        results = view.map(accumulate_files_lags, jobs)
+    merged = [None] * len(lag_times)
+    for result in results:
+        merged = [_add_accumulators(m, acc) for m, acc in zip(merged, result)]
+    return merged
+
+
+def accumulate_series(yaml_file, lag_time, view=None, protein_list=None,
+                      nrm=None, chunk=20, cache=False, traj_filter=None):
+    """
+    :param yaml_file: The yaml file to work with
+    :param lag_time: tICA lag time in frames
+    :param view: ipython view or pool view to parallelize over. Defaults to
+    None which accumulates serially.
+    :param protein_list: list of proteins, if None then all
+    the proteins in yaml_file["protein_list"] are used
+    :param nrm: Optional fit normalizer applied to the features
+    :param chunk: Number of trajectories per job
+    :param cache: Read and write the per trajectory accumulator caches.
+    Normalizers have to be StandardScalers(see normalize_accumulators).
+    :param traj_filter: Optional function of the protein and .jl name that
+    returns False for trajectories to leave out, e.g. a bad project
+    :return: merged accumulators of all the trajectories
+    """
+    return accumulate_series_lags(yaml_file, [lag_time], view, protein_list,
+                                  nrm, chunk, cache, traj_filter)[0]
+
+
+def fit_tica_subset(yaml_file, tica_mdl, protein_list=None, traj_filter=None,
+                    nrm=None, view=None):
+    """
+    Fits a tICA model to a subset of the series from the accumulator
+    caches, which are filled on first use. Only the caches are read once
+    they exist, so e.g. leave one protein out models take seconds.
+    :param yaml_file: The yaml file to work with
+    :param tica_mdl: unfit tICA model, its lag_time picks the cache
+    :param protein_list: list of proteins, if None then all
+    the proteins in yaml_file["protein_list"] are used
+    :param traj_filter: Optional function of the protein and .jl name that
+    returns False for trajectories to leave out
+    :param nrm: Optional fit StandardScaler applied to the features
+    :param view: Optional ipython view or pool view to parallelize over.
+    :return: the fit model
+    """
+    accumulators = accumulate_series(yaml_file, tica_mdl.lag_time, view,
+                                     protein_list=protein_list, nrm=nrm,
+                                     cache=True, traj_filter=traj_filter)
+    return inject_accumulators(tica_mdl, accumulators)
+
+
+def scan_lag_times(yaml_file, tica_mdl, lag_times, view=None,
+                   protein_list=None, nrm=None, cache=False, traj_filter=None):
+    """
+    Fits a tICA model for every lag time from a single pass over the
+    features.
+    :param yaml_file: The yaml file to work with
+    :param tica_mdl: unfit tICA model used as a template, its lag_time is
+    replaced by each of the lag_times
+    :param lag_times: list of lag times in frames
+    :param view: Optional ipython view or pool view to parallelize over.
+    :param protein_list: list of proteins, if None then all
+    the proteins in yaml_file["protein_list"] are used
+    :param nrm: Optional fit normalizer applied to the features
+    :param cache: Also read and write the per trajectory accumulator caches
+    :param traj_filter: Optional function of the protein and .jl name that
+    returns False for trajectories to leave out
+    :return: dictionary of fit models keyed on the lag time and a pandas
+    dataframe with the eigenvalue and implied timescale(in frames) of every
+    component at every lag time
+    """
+    lag_times = list(lag_times)
+    accumulators = accumulate_series_lags(yaml_file, lag_times, view,
+                                          protein_list=protein_list, nrm=nrm,
+                                          cache=cache,
+                                          traj_filter=traj_filter)
+    models = {}
+    rows = []
+    for lag_time, acc in zip(lag_times, accumulators):
+        mdl = clone(tica_mdl).set_params(lag_time=lag_time)
+        models[lag_time] = inject_accumulators(mdl, acc)
+        if acc is None:
+            continue
+        for component, eigenvalue in enumerate(mdl.eigenvalues_):
+            #non positive eigenvalues have no implied timescale
+            timescale = -lag_time / np.log(eigenvalue) \
+                if 0 < eigenvalue < 1 else np.nan
+            rows.append({"lag_time": lag_time, "component": component,
+                         "eigenvalue": eigenvalue, "timescale": timescale})
+    summary = pd.DataFrame(rows, columns=["lag_time", "component",
+                                          "eigenvalue", "timescale"])
+    return models, summary
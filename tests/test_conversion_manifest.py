@@ -0,0 +1,49 @@
+#!/bin/env/python
+
+from kinase_msm.conversion_manifest import scan_clone, load_manifest, \
+    clone_is_current, update_manifest
+from mdtraj.utils.contextmanagers import enter_temp_directory
+import os
+
+
+def test_manifest_roundtrip():
+    with enter_temp_directory():
+        os.makedirs("RUN0/CLONE0")
+        for i in range(3):
+            open("RUN0/CLONE0/results-%.3d.tar.bz2" % i, 'w').close()
+        n_results, results_mtime, last_gen = scan_clone("RUN0/CLONE0")
+        assert n_results == 3 and last_gen == 2
+
+        assert load_manifest(".", "fake_proj") == {}
+        update_manifest(".", [("fake_proj", 0, 0, 2, n_results,
+                               results_mtime, False)])
+        manifest = load_manifest(".", "fake_proj")
+        assert load_manifest(".", "other_proj") == {}
+
+        entry = manifest[(0, 0)]
+        assert clone_is_current(entry, n_results, results_mtime, False)
+        assert clone_is_current(entry, n_results, results_mtime, True)
+        #new gen showed up
+        assert not clone_is_current(entry, n_results + 1,
+                                    results_mtime + 1, False)
+        assert not clone_is_current(None, n_results, results_mtime, False)
+
+        #protein only passes dont cover the full trajectories
+        update_manifest(".", [("fake_proj", 0, 0, 2, n_results,
+                               results_mtime, True)])
+        entry = load_manifest(".", "fake_proj")[(0, 0)]
+        assert clone_is_current(entry, n_results, results_mtime, True)
+        assert not clone_is_current(entry, n_results, results_mtime, False)
+
+        #backups are results* entries but no generation
+        open("RUN0/CLONE0/results-001.tar.bz2.0", 'w').close()
+        n_results, results_mtime, last_gen = scan_clone("RUN0/CLONE0")
+        assert n_results == 4 and last_gen == 2
+        update_manifest(".", [("fake_proj", 0, 0, last_gen, n_results,
+                               results_mtime, False)])
+        entry = load_manifest(".", "fake_proj")[(0, 0)]
+        assert clone_is_current(entry, n_results, results_mtime, False,
+                                last_gen)
+        assert not clone_is_current(entry, n_results + 1, results_mtime + 1,
+                                    False, last_gen + 1)
+    return True
@@ -0,0 +1,62 @@
+#!/bin/env/python
+
+from kinase_msm.convert_planner import plan_conversion, run_plan, \
+    summarize_plan, estimate_wall_time
+from multiprocessing.pool import Pool
+from mdtraj.utils.contextmanagers import enter_temp_directory
+from test_convert_project import _make_fake_results, base_dir
+import shutil
+import os
+import numpy as np
+
+
+def test_plan_conversion():
+    top_file = os.path.join(base_dir, "kinase_1", "fake_proj1",
+                            "topologies", "0.pdb")
+    with enter_temp_directory():
+        proj_folder = os.path.abspath("kinase_1/fake_proj")
+        os.makedirs(os.path.join(proj_folder, "topologies"))
+        shutil.copy(top_file, os.path.join(proj_folder, "topologies"))
+        for clone in range(2):
+            clone_folder = os.path.join(proj_folder, "RUN0",
+                                        "CLONE%d"%clone)
+            os.makedirs(clone_folder)
+            _make_fake_results(top_file)
+            shutil.move("results-000.tar.bz2", clone_folder)
+        yaml_file = {"base_dir": os.path.abspath("."),
+                     "protein_list": ["kinase_1"],
+                     "project_dict": {"kinase_1": ["fake_proj"]}}
+
+        report, jobs = plan_conversion(yaml_file, protein_only=True,
+                                       throughput=1e6)
+        assert len(report) == 2 and len(jobs) == 2
+        assert (report.n_pending == 1).all()
+        assert np.isclose(report.est_seconds.sum(),
+                          report.pending_bytes.sum() / 1e6)
+        assert summarize_plan(report).n_pending["kinase_1"] == 2
+        assert estimate_wall_time(report, 2) == report.est_seconds.max()
+        #planning has no side effects
+        assert not os.path.isdir("kinase_1/protein_traj")
+        yaml_file["feature_dir"] = "feature_dir"
+        _, feat_jobs = plan_conversion(yaml_file, protein_only=True,
+                                       throughput=1e6, feat=object())
+        assert all([job[7]["feature_dir"] == "feature_dir"
+                    for job in feat_jobs])
+
+        #jobs are matched to their row, not their position
+        try:
+            run_plan(report[report.clone == 0], jobs, None)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("ran a job without a report row")
+        p = Pool(1)
+        run_plan(report.sort_values("clone", ascending=False), jobs, p)
+        p.terminate()
+
+        report, jobs = plan_conversion(yaml_file, protein_only=True,
+                                       throughput=1e6)
+        assert len(jobs) == 0
+        assert (report.n_pending == 0).all()
+        assert (report.done_frames == 5).all()
+    return True
@@ -133,3 +133,275 @@ def test_convert_project():
     return True
 
 
+
+def _make_fake_results(top_file, n_frames=5):
+    """
+    Writes a results-000.tar.bz2 with a positions.xtc for the given topology
+    into the current directory
+    """
+    import tarfile
+    import numpy as np
+    top = mdt.load(top_file)
+    trj = mdt.Trajectory(top.xyz.repeat(n_frames, axis=0) +
+                         np.random.normal(0, 0.01, (n_frames, top.n_atoms, 3)),
+                         top.topology)
+    trj.save_xtc("positions.xtc")
+    with tarfile.open("results-000.tar.bz2", "w:bz2") as tar:
+        tar.add("positions.xtc")
+    os.remove("positions.xtc")
+    return top, os.path.abspath("results-000.tar.bz2")
+
+def test_stream_loader():
+    from kinase_msm.convert_project import _traj_loader, _traj_loader_stream
+    top_file = os.path.join(base_dir, "kinase_1", "fake_proj1",
+                            "topologies", "0.pdb")
+    with enter_temp_directory():
+        top, filename = _make_fake_results(top_file)
+        trj = _traj_loader(filename, top)
+        trj2 = _traj_loader_stream(filename, top)
+
+    assert trj.n_frames == trj2.n_frames
+    assert (trj.xyz == trj2.xyz).all()
+    return True
+
+def test_block_write():
+    from kinase_msm.convert_project import HDF5TrajectoryFileWrapper, \
+        _traj_loader_stream
+    top_file = os.path.join(base_dir, "kinase_1", "fake_proj1",
+                            "topologies", "0.pdb")
+    with enter_temp_directory():
+        top, filename = _make_fake_results(top_file, n_frames=7)
+        trj = _traj_loader_stream(filename, top)
+        for block_size in [None, 1, 3]:
+            fname = "block_%s.hdf5" % block_size
+            f = HDF5TrajectoryFile(fname, mode='a')
+            wrapper = HDF5TrajectoryFileWrapper(f, block_size)
+            wrapper.setup(top.topology)
+            wrapper.write_file(filename, trj)
+            f.close()
+            trj2 = mdt.load(fname)
+            assert trj2.n_frames == trj.n_frames
+            assert (trj2.xyz == trj.xyz).all()
+            with HDF5TrajectoryFile(fname) as f:
+                assert list(f._handle.root.processed_filenames) == \
+                       [six.b(filename)]
+    return True
+
+def test_cached_strip():
+    from kinase_msm.convert_project import _load_topology, _strip_solvent
+    top_file = os.path.join(base_dir, "kinase_1", "fake_proj1",
+                            "topologies", "0.pdb")
+    top, str_top, prot_indices = _load_topology(top_file)
+    assert _load_topology(top_file)[0] is top
+    stripped = _strip_solvent(top, str_top, prot_indices)
+    expected = top.remove_solvent()
+    assert stripped.topology == expected.topology
+    assert (stripped.xyz == expected.xyz).all()
+    return True
+
+def test_processed_index():
+    from kinase_msm.convert_project import HDF5TrajectoryFileWrapper, \
+        _traj_loader_stream
+    top_file = os.path.join(base_dir, "kinase_1", "fake_proj1",
+                            "topologies", "0.pdb")
+    with enter_temp_directory():
+        top, filename = _make_fake_results(top_file)
+        trj = _traj_loader_stream(filename, top)
+        f = HDF5TrajectoryFile("index.hdf5", mode='a')
+        wrapper = HDF5TrajectoryFileWrapper(f)
+        wrapper.setup(top.topology)
+        assert not wrapper.check_filename(filename)
+        wrapper.write_file(filename, trj)
+        assert wrapper.check_filename(filename)
+        f.close()
+        #reopening has to pick up the previously processed names
+        f = HDF5TrajectoryFile("index.hdf5", mode='a')
+        wrapper = HDF5TrajectoryFileWrapper(f)
+        wrapper.setup(top.topology)
+        assert wrapper.check_filename(filename)
+        assert wrapper.validate_filename(1, filename.replace("000", "001"),
+                                         [])
+        f.close()
+    return True
+
+def test_ordered_prefetch():
+    from kinase_msm.convert_project import _ordered_prefetch
+
+    def _square(i):
+        if i == 3:
+            raise ValueError("bad results file")
+        return i * i
+
+    for n_prefetch in [0, 2, 5]:
+        out = []
+        for item, result in _ordered_prefetch(_square, range(10), n_prefetch):
+            if isinstance(result, Exception):
+                break
+            out.append((item, result))
+        assert out == [(0, 0), (1, 1), (2, 4)]
+    return True
+
+def test_protein_only_loader():
+    from kinase_msm.convert_project import _load_topology, _strip_solvent, \
+        _traj_loader, _traj_loader_stream
+    top_file = os.path.join(base_dir, "kinase_1", "fake_proj1",
+                            "topologies", "0.pdb")
+    top, str_top, prot_indices = _load_topology(top_file)
+    with enter_temp_directory():
+        top, filename = _make_fake_results(top_file)
+        expected = _strip_solvent(_traj_loader(filename, top),
+                                  str_top, prot_indices)
+        for loader in [_traj_loader, _traj_loader_stream]:
+            trj = loader(filename, str_top, prot_indices)
+            assert trj.topology == str_top.topology
+            assert (trj.xyz == expected.xyz).all()
+    return True
+
+def test_tuned_hdf5_file():
+    from kinase_msm.convert_project import TunedHDF5TrajectoryFile, \
+        HDF5TrajectoryFileWrapper, _traj_loader_stream
+    top_file = os.path.join(base_dir, "kinase_1", "fake_proj1",
+                            "topologies", "0.pdb")
+    with enter_temp_directory():
+        top, filename = _make_fake_results(top_file, n_frames=6)
+        trj = _traj_loader_stream(filename, top)
+        f = TunedHDF5TrajectoryFile("tuned.hdf5", mode='a', chunk_frames=4,
+                                    complib="zlib", complevel=5)
+        wrapper = HDF5TrajectoryFileWrapper(f)
+        wrapper.setup(top.topology)
+        wrapper.write_file(filename, trj)
+        f.close()
+        with HDF5TrajectoryFile("tuned.hdf5") as f:
+            coordinates = f._handle.root.coordinates
+            assert coordinates.chunkshape[0] == 4
+            assert coordinates.filters.complevel == 5
+        assert (mdt.load("tuned.hdf5").xyz == trj.xyz).all()
+
+        #unknown filters fail before the file is created
+        try:
+            TunedHDF5TrajectoryFile("bad.hdf5", mode='a', complib="foo")
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("unknown complib was accepted")
+        assert not os.path.exists("bad.hdf5")
+    return True
+
+def test_quantized_hdf5_file():
+    from kinase_msm.convert_project import TunedHDF5TrajectoryFile, \
+        HDF5TrajectoryFileWrapper, _traj_loader_stream
+    from kinase_msm.data_loader import load_hdf5
+    top_file = os.path.join(base_dir, "kinase_1", "fake_proj1",
+                            "topologies", "0.pdb")
+    with enter_temp_directory():
+        top, filename = _make_fake_results(top_file, n_frames=6)
+        trj = _traj_loader_stream(filename, top)
+        for i in range(2):
+            f = TunedHDF5TrajectoryFile("quantized.hdf5", mode='a',
+                                        precision=1000)
+            wrapper = HDF5TrajectoryFileWrapper(f, block_size=4)
+            wrapper.setup(top.topology)
+            wrapper.write_file("%s%d"%(filename, i), trj)
+            f.close()
+        with HDF5TrajectoryFile("quantized.hdf5") as f:
+            assert "coordinates" not in f._handle.root
+            assert f._handle.root.quantized_coordinates.shape[0] == 12
+        #xtc coordinates are already on the 0.001 nm grid
+        new_trj = load_hdf5("quantized.hdf5")
+        assert new_trj.n_frames == 12
+        assert abs(new_trj.xyz[6:] - trj.xyz).max() < 1e-5
+        frame = load_hdf5("quantized.hdf5", frame_index=7)
+        assert (frame.xyz == new_trj.xyz[7]).all()
+        assert load_hdf5("quantized.hdf5", stride=5).n_frames == 3
+    return True
+
+def test_job_size():
+    from kinase_msm.convert_project import _job_size
+    with enter_temp_directory():
+        proj_folder = os.path.abspath("fake_proj")
+        os.makedirs(os.path.join(proj_folder, "RUN0", "CLONE0", "results1"))
+        os.makedirs(os.path.join(proj_folder, "RUN0", "CLONE1"))
+        with open(os.path.join(proj_folder, "RUN0", "CLONE0",
+                               "results-000.tar.bz2"), 'w') as f:
+            f.write("a" * 100)
+        with open(os.path.join(proj_folder, "RUN0", "CLONE0",
+                               "results1", "positions.xtc"), 'w') as f:
+            f.write("a" * 50)
+        jobs = [("fake_proj", None, proj_folder, None, 0, clone, True)
+                for clone in [1, 0]]
+        assert [_job_size(j) for j in jobs] == [0, 150]
+        assert sorted(jobs, key=_job_size, reverse=True)[0][5] == 0
+    return True
+
+def test_fused_featurization():
+    from kinase_msm.convert_project import TunedHDF5TrajectoryFile, \
+        HDF5TrajectoryFileWrapper, _traj_loader_stream
+    from kinase_msm.featurize_project import FeatureAppender
+    from kinase_msm.data_loader import load_hdf5
+    from msmbuilder.featurizer import DihedralFeaturizer
+    from msmbuilder.utils import verboseload
+    import numpy as np
+    top_file = os.path.join(base_dir, "kinase_1", "fake_proj1",
+                            "topologies", "0.pdb")
+    feat = DihedralFeaturizer(types=["phi", "psi"])
+    with enter_temp_directory():
+        top, filename = _make_fake_results(top_file, n_frames=5)
+        trj = _traj_loader_stream(filename, top).remove_solvent()
+        os.makedirs(os.path.join("kinase_1", "protein_traj"))
+        yaml_file = {"base_dir": os.path.abspath("."),
+                     "feature_dir": "feature_dir"}
+        traj_file = os.path.join("kinase_1", "protein_traj", "fake_0_0.hdf5")
+        #the first gen is converted without features, the next two with
+        for i in range(3):
+            appender = None
+            if i > 0:
+                appender = FeatureAppender(yaml_file, "kinase_1", traj_file,
+                                           feat, stride=2)
+            f = TunedHDF5TrajectoryFile(traj_file, mode='a')
+            wrapper = HDF5TrajectoryFileWrapper(f)
+            wrapper.setup(trj.topology)
+            wrapper.write_file("%s%d"%(filename, i), trj)
+            if appender is not None:
+                appender.append(trj)
+            f.close()
+            if appender is not None:
+                appender.close()
+        features = verboseload(os.path.join("kinase_1", "feature_dir",
+                                            "fake_0_0.jl"))
+        expected = feat.partial_transform(load_hdf5(traj_file, stride=2))
+        assert features.shape == (8, expected.shape[1])
+        assert np.allclose(features, expected)
+        assert os.path.isfile(os.path.join("kinase_1", "feature_dir",
+                                           "feature_descriptor.h5"))
+    return True
+
+def test_dynamic_map():
+    from kinase_msm import convert_project
+    from kinase_msm.convert_project import _dynamic_map
+
+    class FakeLoadBalancedView(object):
+        def __init__(self, targets):
+            self.targets = targets
+        def map(self, func, jobs):
+            return iter([func(job) for job in jobs])
+
+    class FakeClient(object):
+        def load_balanced_view(self, targets=None):
+            return FakeLoadBalancedView(targets)
+
+    class FakeDirectView(object):
+        client = FakeClient()
+        targets = [0, 1]
+        def map(self, func, jobs):
+            raise AssertionError("direct views split the jobs statically")
+
+    direct_view = convert_project.DirectView
+    convert_project.DirectView = FakeDirectView
+    try:
+        assert _dynamic_map(FakeDirectView(), abs, [-1, 2, -3]) == [1, 2, 3]
+    finally:
+        convert_project.DirectView = direct_view
+    p = Pool(2)
+    assert list(_dynamic_map(p, abs, [-1, 2, -3])) == [1, 2, 3]
+    p.terminate()
+    return True
@@ -15,3 +15,29 @@ def test_change_protein_data_dir():
             current_folder_path, current_folder_name = os.path.split(os.getcwd())
             assert current_folder_name == "fake_kinase1"
     return
+
+
+def test_load_topology():
+    from kinase_msm.data_loader import load_topology, load_random_frame, \
+        _topology_cache
+    import mdtraj as mdt
+    top = mdt.load(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "test_data", "kinase_1", "fake_proj1",
+                                "topologies", "0.pdb"))
+    with enter_temp_directory():
+        os.makedirs("fake_kinase/protein_traj")
+        top.remove_solvent().save_hdf5("fake_kinase/protein_traj/0_0_0.hdf5")
+        yaml_file = {"base_dir": os.path.abspath("."),
+                     "protein_dir": "protein_traj"}
+        prt_top = load_topology(yaml_file, "fake_kinase")
+        assert prt_top == top.remove_solvent().topology
+        #second call comes from the cache even without any trajectory
+        os.remove("fake_kinase/protein_traj/0_0_0.hdf5")
+        assert load_topology(yaml_file, "fake_kinase") is prt_top
+        _topology_cache.clear()
+
+        top.remove_solvent().save_hdf5("fake_kinase/protein_traj/0_0_0.hdf5")
+        frame = load_random_frame(yaml_file, "fake_kinase")
+        assert frame.n_frames == 1
+        assert frame.topology == prt_top
+    return
@@ -0,0 +1,118 @@
+#!/bin/env/python
+
+from kinase_msm.feature_store import FeatureStore, build_feature_store, \
+    open_feature_store, iter_protein_features, load_features
+from msmbuilder.utils import verbosedump
+from mdtraj.utils.contextmanagers import enter_temp_directory
+import numpy as np
+import time
+import os
+
+
+def test_feature_store():
+    with enter_temp_directory():
+        os.makedirs("kinase_1/feature_dir")
+        yaml_file = {"base_dir": os.path.abspath("."),
+                     "feature_dir": "feature_dir"}
+        all_data = {}
+        for i in [0, 2, 10]:
+            all_data["%d.jl"%i] = np.random.randn(5 + i, 4).astype(np.float32)
+            verbosedump(all_data["%d.jl"%i],
+                        os.path.join("kinase_1/feature_dir", "%d.jl"%i))
+        assert open_feature_store("kinase_1/feature_dir") is None
+
+        time.sleep(0.01)
+        store = build_feature_store("kinase_1/feature_dir")
+        assert isinstance(store, FeatureStore)
+        assert len(store) == 3
+        for name in all_data.keys():
+            assert isinstance(store[name], np.memmap)
+            assert np.array_equal(store[name], all_data[name])
+            assert store.n_frames(name) == len(all_data[name])
+            assert np.array_equal(store.read(name, [1, 3]),
+                                  all_data[name][:, [1, 3]])
+            assert np.array_equal(
+                load_features(os.path.join("kinase_1/feature_dir", name),
+                              [2], from_store=True),
+                all_data[name][:, [2]])
+
+        names = [name for name, _ in iter_protein_features(yaml_file,
+                                                           "kinase_1")]
+        assert names == ["0.jl", "2.jl", "10.jl"]
+        assert [name for name, _ in iter_protein_features(
+            yaml_file, "kinase_1", file_stride=2)] == ["0.jl", "10.jl"]
+
+        #newer .jl files make the store stale
+        all_data["2.jl"] = np.zeros((3, 4), dtype=np.float32)
+        verbosedump(all_data["2.jl"], "kinase_1/feature_dir/2.jl")
+        future = time.time() + 10
+        os.utime("kinase_1/feature_dir/2.jl", (future, future))
+        assert open_feature_store("kinase_1/feature_dir") is None
+        for name, features in iter_protein_features(yaml_file, "kinase_1"):
+            assert not isinstance(features, np.memmap)
+            assert np.array_equal(features, all_data[name])
+    return True
+
+
+def test_prefetch_features():
+    from kinase_msm.feature_store import prefetch_features
+    import threading
+    lock = threading.Lock()
+    loaded = []
+    consumed = []
+
+    def _load(item):
+        with lock:
+            loaded.append(item)
+        return item * 2
+
+    for n_prefetch, max_bytes in [(0, None), (3, None), (3, 20), (3, 5)]:
+        del loaded[:]
+        del consumed[:]
+        for item, result in prefetch_features(_load, range(10), n_prefetch,
+                                              max_bytes, size=lambda i: 10):
+            assert result == 2 * item
+            with lock:
+                #loads ahead are bounded by the lookahead and the budget
+                ahead = len(loaded) - len(consumed) - 1
+            assert ahead <= n_prefetch
+            if max_bytes is not None:
+                assert ahead <= max(1, max_bytes // 10)
+            consumed.append(item)
+        assert consumed == list(range(10))
+
+    def _fail(item):
+        raise ValueError(item)
+    try:
+        list(prefetch_features(_fail, range(3)))
+    except ValueError:
+        pass
+    else:
+        assert False
+    return True
+
+
+def test_feature_store_rewrite():
+    from kinase_msm.feature_store import write_feature_store, _store_cache
+    import glob
+    with enter_temp_directory():
+        folder = os.path.abspath("store")
+        os.makedirs(folder)
+        old_data = np.random.randn(10, 3)
+        old = write_feature_store(folder, [("0.jl", old_data)])
+
+        #the new index never pairs with the old data file
+        time.sleep(0.01)
+        new_data = np.random.randn(4, 3)
+        new = write_feature_store(folder, [("1.jl", new_data[:1]),
+                                           ("0.jl", new_data[1:])])
+        assert new.generation != old.generation
+        assert len(glob.glob(os.path.join(folder, "_features*.dat"))) == 1
+        assert np.array_equal(new["0.jl"], new_data[1:])
+        #open maps of the old generation stay valid
+        assert np.array_equal(old["0.jl"], old_data)
+
+        #only the latest store of the folder is cached
+        assert [key for key in _store_cache if key[0] == folder] == \
+            [(folder, os.stat(os.path.join(folder, "_index.pkl")).st_mtime)]
+    return True
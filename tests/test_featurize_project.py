@@ -10,7 +10,9 @@ from msmbuilder.utils import verboseload
 import glob
 import os
 import numpy as np
+import pandas as pd
 import mdtraj as mdt
+from mdtraj.utils.contextmanagers import enter_temp_directory
 
 if os.path.isdir("tests"):
     base_dir = os.path.abspath(os.path.join("./tests/test_data"))
@@ -47,3 +49,157 @@ def test_dihedral_feat():
 
     return True
 
+
+
+def test_chunked_featurization():
+    from kinase_msm.featurize_project import featurize_file
+    top = mdt.load(os.path.join(base_dir, "kinase_1", "fake_proj1",
+                                "topologies", "0.pdb"))
+    trj = mdt.Trajectory(top.xyz.repeat(11, axis=0) +
+                         np.random.normal(0, 0.01, (11, top.n_atoms, 3)),
+                         top.topology)
+    feat = DihedralFeaturizer(types=['phi', 'psi','chi1'])
+    with enter_temp_directory():
+        os.makedirs("kinase_1/protein_traj")
+        trj.save_hdf5("kinase_1/protein_traj/fake_0_0.hdf5")
+        yaml_file = {"base_dir": os.path.abspath("."),
+                     "feature_dir": "features"}
+        for stride in [1, 3]:
+            featurize_file((yaml_file, "kinase_1", feat,
+                            "kinase_1/protein_traj/fake_0_0.hdf5", stride,
+                            {"chunk": 2}))
+            calc_feat = verboseload("kinase_1/features/fake_0_0.jl")
+            assert np.allclose(calc_feat,
+                               feat.partial_transform(trj[::stride]))
+    return True
+
+
+def test_multi_featurizer():
+    from kinase_msm.featurize_project import featurize_file
+    from msmbuilder.featurizer import ContactFeaturizer
+    top = mdt.load(os.path.join(base_dir, "kinase_1", "fake_proj1",
+                                "topologies", "0.pdb"))
+    trj = mdt.Trajectory(top.xyz.repeat(5, axis=0) +
+                         np.random.normal(0, 0.01, (5, top.n_atoms, 3)),
+                         top.topology)
+    feats = {"dihedral_features": DihedralFeaturizer(types=['phi', 'psi']),
+             "contact_features": ContactFeaturizer()}
+    with enter_temp_directory():
+        os.makedirs("kinase_1/protein_traj")
+        trj.save_hdf5("kinase_1/protein_traj/fake_0_0.hdf5")
+        yaml_file = {"base_dir": os.path.abspath("."),
+                     "feature_dir": "features"}
+        featurize_file((yaml_file, "kinase_1", feats,
+                        "kinase_1/protein_traj/fake_0_0.hdf5", 1,
+                        {"chunk": 2}))
+        for folder_name, feat in feats.items():
+            calc_feat = verboseload(os.path.join("kinase_1", folder_name,
+                                                 "fake_0_0.jl"))
+            assert np.allclose(calc_feat, feat.partial_transform(trj))
+            assert os.path.isfile(os.path.join("kinase_1", folder_name,
+                                               "feature_descriptor.h5"))
+        assert not os.path.isdir("kinase_1/features")
+    return True
+
+
+def test_incremental_featurization():
+    from kinase_msm.featurize_project import featurize_file
+    from mdtraj.formats.hdf5 import HDF5TrajectoryFile
+    top = mdt.load(os.path.join(base_dir, "kinase_1", "fake_proj1",
+                                "topologies", "0.pdb"))
+    trj = mdt.Trajectory(top.xyz.repeat(11, axis=0) +
+                         np.random.normal(0, 0.01, (11, top.n_atoms, 3)),
+                         top.topology)
+    feats = {"dihedral_features": DihedralFeaturizer(types=['phi', 'psi']),
+             "chi_features": DihedralFeaturizer(types=['chi1'])}
+    with enter_temp_directory():
+        os.makedirs("kinase_1/protein_traj")
+        traj_file = "kinase_1/protein_traj/fake_0_0.hdf5"
+        trj[:7].save_hdf5(traj_file)
+        yaml_file = {"base_dir": os.path.abspath("."),
+                     "feature_dir": "features"}
+        job = (yaml_file, "kinase_1", feats, traj_file, 2,
+               {"chunk": 2, "incremental": True})
+        featurize_file(job)
+        out_files = [os.path.join("kinase_1", folder_name, "fake_0_0.jl")
+                     for folder_name in feats.keys()]
+        assert os.path.isfile("kinase_1/chi_features/.featurize_state/"
+                              "fake_0_0.json")
+
+        #unchanged trajectories are skipped
+        mtimes = [os.stat(i).st_mtime for i in out_files]
+        featurize_file(job)
+        assert mtimes == [os.stat(i).st_mtime for i in out_files]
+
+        #grown trajectories only get the tail appended
+        with HDF5TrajectoryFile(traj_file, mode='a') as f:
+            f.write(trj.xyz[7:], time=trj.time[7:])
+        featurize_file(job)
+        for folder_name, feat in feats.items():
+            calc_feat = verboseload(os.path.join("kinase_1", folder_name,
+                                                 "fake_0_0.jl"))
+            assert np.allclose(calc_feat, feat.partial_transform(trj[::2]))
+
+        #a different featurizer redoes the whole trajectory
+        feats["chi_features"] = DihedralFeaturizer(types=['phi'])
+        featurize_file(job)
+        calc_feat = verboseload("kinase_1/chi_features/fake_0_0.jl")
+        assert np.allclose(calc_feat,
+                           feats["chi_features"].partial_transform(trj[::2]))
+    return True
+
+
+def test_atom_subset_featurization():
+    from kinase_msm.featurize_project import featurize_file, \
+        _subset_featurizers
+    from msmbuilder.featurizer import ContactFeaturizer
+    top = mdt.load(os.path.join(base_dir, "kinase_1", "fake_proj1",
+                                "topologies", "0.pdb")).remove_solvent()
+    trj = mdt.Trajectory(top.xyz.repeat(5, axis=0) +
+                         np.random.normal(0, 0.01, (5, top.n_atoms, 3)),
+                         top.topology)
+    feats = {"dihedral_features": DihedralFeaturizer(types=['phi', 'psi',
+                                                            'chi1']),
+             "contact_features": ContactFeaturizer(contacts=[[0, 5],
+                                                             [3, 10]])}
+    atom_indices, sub_feats = _subset_featurizers(feats, trj[0])
+    assert atom_indices is not None and len(atom_indices) < top.n_atoms
+    assert _subset_featurizers({"all": ContactFeaturizer()}, trj[0])[0] is None
+    with enter_temp_directory():
+        os.makedirs("kinase_1/protein_traj")
+        trj.save_hdf5("kinase_1/protein_traj/fake_0_0.hdf5")
+        yaml_file = {"base_dir": os.path.abspath("."),
+                     "feature_dir": "features"}
+        featurize_file((yaml_file, "kinase_1", feats,
+                        "kinase_1/protein_traj/fake_0_0.hdf5", 1,
+                        {"chunk": 2, "atom_subset": True}))
+        for folder_name, feat in feats.items():
+            calc_feat = verboseload(os.path.join("kinase_1", folder_name,
+                                                 "fake_0_0.jl"))
+            assert np.allclose(calc_feat, feat.partial_transform(trj))
+            df = verboseload(os.path.join("kinase_1", folder_name,
+                                          "feature_descriptor.h5"))
+            assert df.equals(pd.DataFrame(feat.describe_features(trj[0])))
+    return True
+
+
+def test_misformed_trajectory():
+    from kinase_msm.featurize_project import featurize_file, FeatureAppender
+    feat = DihedralFeaturizer(types=['phi', 'psi'])
+    with enter_temp_directory():
+        os.makedirs("kinase_1/protein_traj")
+        traj_file = "kinase_1/protein_traj/fake_0_0.hdf5"
+        yaml_file = {"base_dir": os.path.abspath("."),
+                     "feature_dir": "features"}
+        with open(traj_file, "w") as f:
+            f.write("not a trajectory")
+
+        #the conversion owns the file, so catching up keeps it
+        appender = FeatureAppender(yaml_file, "kinase_1", traj_file, feat)
+        assert os.path.isfile(traj_file)
+        assert len(appender.feats) == 0
+
+        featurize_file((yaml_file, "kinase_1", feat, traj_file, 1,
+                        {"incremental": True}))
+        assert not os.path.isfile(traj_file)
+    return True
@@ -37,3 +37,99 @@ def test_normalize_features():
     assert(np.alltrue(np.isclose(np.std(all_data, axis=1), 1 , atol=0.3)))
 
 
+
+def test_streaming_normalizer():
+    from kinase_msm.normalize_features import fit_normalizer
+    from msmbuilder.utils import verbosedump
+    from mdtraj.utils.contextmanagers import enter_temp_directory
+    from sklearn.preprocessing import StandardScaler
+    with enter_temp_directory():
+        yaml_file = {"base_dir": os.path.abspath("."),
+                     "feature_dir": "feature_dir",
+                     "protein_list": ["kinase_1", "kinase_2"]}
+        all_data = []
+        for kinase in yaml_file["protein_list"]:
+            os.makedirs(os.path.join(kinase, "feature_dir"))
+            for i in range(3):
+                features = np.random.normal(i, i + 1, (10 * (i + 1), 4))
+                verbosedump(features, os.path.join(kinase, "feature_dir",
+                                                   "fake_0_%d.jl"%i))
+                all_data.append(features)
+        nrm = fit_normalizer(yaml_file)
+        ref = StandardScaler().fit(np.concatenate(all_data))
+        assert np.allclose(nrm.mean_, ref.mean_)
+        assert np.allclose(nrm.scale_, ref.scale_)
+        assert nrm.n_samples_seen_ == 120
+    return True
+
+def test_parallel_and_lazy_normalization():
+    from kinase_msm.feature_store import iter_protein_features
+    from msmbuilder.utils import verbosedump
+    from mdtraj.utils.contextmanagers import enter_temp_directory
+    from multiprocessing.pool import Pool
+    with enter_temp_directory():
+        yaml_file = {"base_dir": os.path.abspath("."),
+                     "mdl_dir": os.path.abspath("mdl_dir"),
+                     "feature_dir": "feature_dir",
+                     "protein_list": ["kinase_1", "kinase_2"]}
+        os.makedirs("mdl_dir")
+        for kinase in yaml_file["protein_list"]:
+            os.makedirs(os.path.join(kinase, "feature_dir"))
+            for i in range(5):
+                verbosedump(np.random.normal(i, 2, (10, 3)),
+                            os.path.join(kinase, "feature_dir",
+                                         "fake_0_%d.jl"%i))
+        nrm = normalize_project_series(yaml_file, lazy=True)
+        assert len(glob.glob("*/normalized_features/*.jl")) == 0
+        pool = Pool(2)
+        normalize_project_series(yaml_file, nrm=nrm, view=pool, chunk=2)
+        pool.terminate()
+        for kinase in yaml_file["protein_list"]:
+            lazy = dict(iter_protein_features(yaml_file, kinase, nrm=nrm))
+            written = dict(iter_protein_features(yaml_file, kinase,
+                                                 "normalized_features"))
+            assert sorted(lazy.keys()) == sorted(written.keys())
+            assert len(written) == 5
+            for f in lazy.keys():
+                assert np.allclose(lazy[f], written[f])
+    return True
+
+
+class _AsyncPoolView(object):
+    #pool view whose map returns before the jobs are done, like the non
+    #blocking ipython views
+    def __init__(self, pool):
+        self.pool = pool
+
+    def map(self, func, jobs):
+        return self.pool.imap_unordered(func, jobs)
+
+
+def test_parallel_normalization_waits_for_the_view():
+    from msmbuilder.utils import verbosedump
+    from mdtraj.utils.contextmanagers import enter_temp_directory
+    from multiprocessing.pool import Pool
+    with enter_temp_directory():
+        yaml_file = {"base_dir": os.path.abspath("."),
+                     "mdl_dir": os.path.abspath("mdl_dir"),
+                     "feature_dir": "feature_dir",
+                     "protein_list": ["kinase_1", "kinase_2"]}
+        os.makedirs("mdl_dir")
+        expected = []
+        for kinase in yaml_file["protein_list"]:
+            os.makedirs(os.path.join(kinase, "feature_dir"))
+            for i in range(6):
+                verbosedump(np.random.normal(i, 2, (10, 3)),
+                            os.path.join(kinase, "feature_dir",
+                                         "fake_0_%d.jl"%i))
+                expected.append(os.path.join(kinase, "normalized_features",
+                                             "fake_0_%d.jl"%i))
+        pool = Pool(2)
+        try:
+            normalize_project_series(yaml_file, view=_AsyncPoolView(pool),
+                                     chunk=1)
+            #every file has to be there once the call returns
+            assert all(os.path.isfile(f) for f in expected)
+        finally:
+            pool.terminate()
+    return True
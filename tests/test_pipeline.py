@@ -1,8 +1,10 @@
 #!/bin/env python
 
 from __future__ import print_function
+import glob
+import os
 import numpy as np
-from msmbuilder.utils import verbosedump
+from msmbuilder.utils import verbosedump, verboseload
 from kinase_msm.series_setup import setup_series_analysis
 from kinase_msm.fit_transform_kinase_series import *
 from mdtraj.utils.contextmanagers import enter_temp_directory
@@ -54,11 +56,43 @@ def test_pipeline():
         tica_mdl = verboseload(os.path.join(mdl_dir,"tica_mdl.pkl"))
         #make sure the mdl is seeing all the data, could probably have a far stronger test here
         assert tica_mdl.n_observations_ == raw_count_obs
-        assert os.path.exists(os.path.join(mdl_dir,"kinase_1/tica_data.pkl"))
-        assert os.path.exists(os.path.join(mdl_dir,"kinase_2/tica_data.pkl"))
+        assert os.path.exists(os.path.join(mdl_dir,"kinase_1/tica_data/_index.pkl"))
+        assert os.path.exists(os.path.join(mdl_dir,"kinase_2/tica_data/_index.pkl"))
         assert os.path.exists(os.path.join(mdl_dir,"kinase_1/msm_mdl.pkl"))
         assert os.path.exists(os.path.join(mdl_dir,"kinase_2/msm_mdl.pkl"))
         assert os.path.exists(os.path.join(mdl_dir,"kinase_2/bootstrap_msm_mdl.pkl"))
         assert os.path.exists(os.path.join(mdl_dir,"kmeans_mdl.pkl"))
 
         return
+
+def test_parallel_tica_transform():
+    from kinase_msm.feature_store import load_tica_data, FeatureStore
+    from multiprocessing.pool import Pool
+    with enter_temp_directory():
+        base_dir = os.path.abspath(os.path.curdir)
+        mdl_dir = os.path.join(base_dir,"mdl_dir")
+        protein_list = ["kinase_1", "kinase_2"]
+        project_dict = {"kinase_1": ["fake_proj1",],
+                        "kinase_2": ["fake_proj2"]}
+        mdl_params = {'tica__n_components': 2, 'tica__lag_time': 1}
+        create_fake_data(base_dir, protein_list, project_dict)
+        yaml_file = setup_series_analysis(base_dir, mdl_dir, "feature_dir",
+                                          "fake_series", protein_list,
+                                          project_dict, mdl_params)
+        fit_protein_tica(yaml_file)
+        pool = Pool(2)
+        transform_protein_tica(yaml_file, view=pool, chunk=2)
+        pool.terminate()
+        tica_mdl = verboseload(os.path.join(mdl_dir, "tica_mdl.pkl"))
+        for protein in protein_list:
+            tica_data = load_tica_data(os.path.join(mdl_dir, protein))
+            assert isinstance(tica_data, FeatureStore)
+            assert list(tica_data.keys()) == ["%d.jl"%i for i in range(5)]
+            for i in range(5):
+                X = verboseload(os.path.join(protein, "feature_dir",
+                                             "%d.jl"%i))
+                assert np.allclose(tica_data["%d.jl"%i],
+                                   tica_mdl.partial_transform(X))
+            assert len(glob.glob(os.path.join(mdl_dir, protein,
+                                              "tica_data", "*.npy"))) == 0
+        return True
@@ -0,0 +1,168 @@
+#!/bin/env/python
+
+from kinase_msm.tica_covariance import accumulate_series, \
+    inject_accumulators, trajectory_accumulators
+from kinase_msm.feature_store import build_feature_store
+from msmbuilder.decomposition import tICA
+from msmbuilder.utils import verbosedump, verboseload
+from mdtraj.utils.contextmanagers import enter_temp_directory
+from multiprocessing.pool import Pool
+import numpy as np
+import os
+
+
+def _setup_features(yaml_file):
+    for kinase in yaml_file["protein_list"]:
+        os.makedirs(os.path.join(kinase, yaml_file["feature_dir"]))
+        for i in range(6):
+            #the last trajectory is shorter than the lag time
+            n_frames = 2 if i == 5 else 20 + i
+            features = np.cumsum(np.random.normal(0, 1, (n_frames, 4)),
+                                 axis=0)
+            verbosedump(features, os.path.join(kinase,
+                                               yaml_file["feature_dir"],
+                                               "fake_0_%d.jl"%i))
+
+
+def test_parallel_tica_fit():
+    with enter_temp_directory():
+        yaml_file = {"base_dir": os.path.abspath("."),
+                     "feature_dir": "feature_dir",
+                     "protein_list": ["kinase_1", "kinase_2"]}
+        _setup_features(yaml_file)
+        build_feature_store(os.path.join("kinase_2", "feature_dir"))
+
+        serial = tICA(n_components=2, lag_time=3)
+        for kinase in yaml_file["protein_list"]:
+            for i in range(5):
+                serial.partial_fit(verboseload(os.path.join(
+                    kinase, "feature_dir", "fake_0_%d.jl"%i)))
+
+        pool = Pool(2)
+        accumulators = accumulate_series(yaml_file, 3, pool, chunk=4)
+        pool.terminate()
+        parallel = inject_accumulators(tICA(n_components=2, lag_time=3),
+                                       accumulators)
+        assert parallel.n_sequences_ == serial.n_sequences_ == 10
+        assert parallel.n_observations_ == serial.n_observations_
+        assert np.allclose(parallel.eigenvalues_, serial.eigenvalues_)
+        assert np.allclose(np.abs(parallel.eigenvectors_),
+                           np.abs(serial.eigenvectors_))
+        assert trajectory_accumulators(np.zeros((3, 4)), 3) is None
+    return True
+
+
+def test_cached_tica_fit():
+    from kinase_msm.tica_covariance import fit_tica_subset
+    from sklearn.preprocessing import StandardScaler
+    with enter_temp_directory():
+        yaml_file = {"base_dir": os.path.abspath("."),
+                     "feature_dir": "feature_dir",
+                     "protein_list": ["kinase_1", "kinase_2"]}
+        _setup_features(yaml_file)
+        features = [verboseload(os.path.join("kinase_1", "feature_dir",
+                                             "fake_0_%d.jl"%i))
+                    for i in range(5)]
+        nrm = StandardScaler().fit(np.concatenate(features))
+
+        #leaves out kinase_2 and the first trajectory of kinase_1
+        def traj_filter(protein, name):
+            return name != "fake_0_0.jl"
+        serial = tICA(n_components=2, lag_time=3)
+        for X in features[1:]:
+            serial.partial_fit(nrm.transform(X))
+
+        for i in range(2):
+            cached = fit_tica_subset(yaml_file, tICA(n_components=2,
+                                                     lag_time=3),
+                                     protein_list=["kinase_1"],
+                                     traj_filter=traj_filter, nrm=nrm)
+            assert cached.n_sequences_ == 4
+            assert np.allclose(cached.eigenvalues_, serial.eigenvalues_)
+        assert len(os.listdir(os.path.join("kinase_1", "feature_dir",
+                                           "tica_cov_lag3"))) == 5
+        assert not os.path.isdir(os.path.join("kinase_2", "feature_dir",
+                                              "tica_cov_lag3"))
+    return True
+
+
+def test_lag_time_scan():
+    from kinase_msm.tica_covariance import scan_lag_times
+    with enter_temp_directory():
+        yaml_file = {"base_dir": os.path.abspath("."),
+                     "feature_dir": "feature_dir",
+                     "protein_list": ["kinase_1", "kinase_2"]}
+        _setup_features(yaml_file)
+        features = [verboseload(os.path.join(kinase, "feature_dir",
+                                             "fake_0_%d.jl"%i))
+                    for kinase in yaml_file["protein_list"]
+                    for i in range(6)]
+        lag_times = [1, 2, 5]
+        for cache in [False, True]:
+            models, summary = scan_lag_times(yaml_file,
+                                             tICA(n_components=2),
+                                             lag_times, cache=cache)
+            assert sorted(models.keys()) == lag_times
+            assert len(summary) == 2 * len(lag_times)
+            for lag_time in lag_times:
+                serial = tICA(n_components=2, lag_time=lag_time)
+                for X in features:
+                    if len(X) > lag_time:
+                        serial.partial_fit(X)
+                assert models[lag_time].lag_time == lag_time
+                assert models[lag_time].n_sequences_ == serial.n_sequences_
+                assert np.allclose(models[lag_time].eigenvalues_,
+                                   serial.eigenvalues_)
+                assert np.allclose(
+                    summary[summary.lag_time == lag_time].eigenvalue,
+                    serial.eigenvalues_)
+    return True
+
+
+def test_bad_files_are_skipped():
+    with enter_temp_directory():
+        yaml_file = {"base_dir": os.path.abspath("."),
+                     "feature_dir": "feature_dir",
+                     "protein_list": ["kinase_1"]}
+        _setup_features(yaml_file)
+        feature_folder = os.path.join("kinase_1", "feature_dir")
+        with open(os.path.join(feature_folder, "fake_0_10.jl"), "w") as f:
+            f.write("not a feature file")
+        #features of the wrong width can not be merged
+        verbosedump(np.random.normal(0, 1, (20, 3)),
+                    os.path.join(feature_folder, "fake_0_11.jl"))
+
+        serial = tICA(n_components=2, lag_time=3)
+        for i in range(5):
+            serial.partial_fit(verboseload(os.path.join(
+                feature_folder, "fake_0_%d.jl"%i)))
+        for cache in [False, True]:
+            accumulators = accumulate_series(yaml_file, 3, chunk=20,
+                                             cache=cache)
+            fit = inject_accumulators(tICA(n_components=2, lag_time=3),
+                                      accumulators)
+            assert fit.n_sequences_ == serial.n_sequences_ == 5
+            assert np.allclose(fit.eigenvalues_, serial.eigenvalues_)
+    return True
+
+
+def test_no_readable_trajectories():
+    from kinase_msm.fit_transform_kinase_series import fit_protein_tica
+    with enter_temp_directory():
+        yaml_file = {"base_dir": os.path.abspath("."),
+                     "mdl_dir": os.path.abspath("mdl_dir"),
+                     "feature_dir": "feature_dir",
+                     "protein_list": ["kinase_1"],
+                     "mdl_params": {"tica__lag_time": 3}}
+        os.makedirs(os.path.join("kinase_1", "feature_dir"))
+        with open(os.path.join("kinase_1", "feature_dir", "fake_0_0.jl"),
+                  "w") as f:
+            f.write("not a feature file")
+        try:
+            fit_protein_tica(yaml_file, cache=True)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("fit without any trajectories")
+        assert not os.path.isfile(os.path.join("mdl_dir", "tica_mdl.pkl"))
+    return True